@@ -0,0 +1,346 @@
+"""Offline benchmark for the bot's hot paths.
+
+Runs main.py's real handlers (quiz, send_sentence, send_reminder) against two
+local stand-in servers: a fake DeepSeek /v1/chat/completions endpoint with
+configurable latency and error rate, and a fake Telegram Bot API that can
+answer with flood-wait (429) errors. No network access is needed.
+
+Usage:
+    python bench.py
+    python bench.py --quiz-runs 50 --chat-counts 1,10,50,100 --llm-latency 1.5 --flood-rate 0.02
+    python bench.py --output bench_output.txt
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+# Keep the benchmark away from real credentials and on-disk state.
+os.environ.update({
+    "TELEGRAM_BOT_TOKEN": "123456:BENCH",
+    "DEEPSEEK_API_KEY": "bench",
+    "TARGET_CHAT_CONFIG": "",
+    "REMINDER_CHAT_ID": "",
+    "REMINDER_CONFIG": "",
+    "STATE_BACKEND": "memory",
+    "TRANSLATION_CACHE_PATH": "",
+    "SENTENCE_POOL_PATH": "",
+    "OUTBOX_PATH": "",
+})
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, CallbackContext  # noqa: E402
+
+TEACHER_CHAT_ID = 1
+
+
+async def start_http_server(handler, host: str = "127.0.0.1"):
+    """Serve a fake upstream with main's HTTP server on a free port; returns (server, port)."""
+    server = await main.start_http_server(handler, host, 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+class FakeDeepSeek:
+    """Stand-in for /v1/chat/completions that answers in the formats main.py expects."""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = {"generate": 0, "translate": 0, "errors": 0}
+
+    def _reply(self, prompt: str):
+        if "JSON" in prompt:
+            reply = {}
+            for number, langs in re.findall(r'^(\d+)\. Russian: .*\n\s*Languages[^:]*: (.*)$', prompt, re.M):
+                reply[number] = {c: f"[{c}] translated sentence" for c in re.findall(r'"(\w+)":', langs)}
+            return "translate", json.dumps(reply, ensure_ascii=False)
+        if "Translate" in prompt:
+            return "translate", "Translated sentence"
+        # One numbered line per requested structure, in prompt order
+        found = sorted(
+            (prompt.find(g), i) for i, g in enumerate(main.GRAMMAR_STRUCTURES) if g in prompt
+        )
+        lines = [f"{n}. {main.FALLBACK_SENTENCES[i]}" for n, (_, i) in enumerate(found, 1)]
+        return "generate", "\n".join(lines)
+
+    async def handle(self, method, path, headers, body):
+        payload = json.loads(body)
+        prompt = payload["messages"][-1]["content"]  # the variable suffix; the system prefix is static
+        kind, content = self._reply(prompt)
+        self.calls[kind] += 1
+        delay = max(0.0, random.gauss(self.latency, self.jitter))
+        if random.random() < self.error_rate:
+            self.calls["errors"] += 1
+            await asyncio.sleep(delay)
+            return 500, "application/json", b'{"error": {"message": "fake upstream error"}}'
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4}
+
+        if payload.get("stream"):
+            async def events():
+                pieces = [content[i:i + 12] for i in range(0, len(content), 12)]
+                for piece in pieces:
+                    await asyncio.sleep(delay / max(1, len(pieces)))
+                    event = {"choices": [{"delta": {"content": piece}}]}
+                    yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode()
+                yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode()
+                yield b"data: [DONE]\n\n"
+            return 200, "text/event-stream", events()
+
+        await asyncio.sleep(delay)
+        data = {"choices": [{"message": {"role": "assistant", "content": content}}], "usage": usage}
+        return 200, "application/json", json.dumps(data, ensure_ascii=False).encode()
+
+
+class FakeTelegram:
+    """Stand-in for the Bot API methods the handlers use, with optional flood-waits."""
+
+    def __init__(self, latency: float, flood_rate: float, retry_after: int):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = {}
+        self.flood_waits = 0
+        self._message_id = 1000
+
+    def _message(self, chat_id, text=""):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "group"},
+            "text": text,
+        }
+
+    async def handle(self, method, path, headers, body):
+        api_method = path.rsplit("/", 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        await asyncio.sleep(self.latency)
+
+        # Only fan-out sends get flood-waits; the teacher's own chat stays clean
+        is_fan_out = api_method == "sendMessage" and params.get("chat_id") != str(TEACHER_CHAT_ID)
+        if is_fan_out and random.random() < self.flood_rate:
+            self.flood_waits += 1
+            error = {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+            return 429, "application/json", json.dumps(error).encode()
+
+        if api_method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif api_method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            result = self._message(params.get("chat_id", TEACHER_CHAT_ID), params.get("text", ""))
+        else:
+            result = True
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+
+# --- Update builders ---
+USER = {"id": TEACHER_CHAT_ID, "is_bot": False, "first_name": "Teacher"}
+CHAT = {"id": TEACHER_CHAT_ID, "type": "private"}
+
+
+def command_update(bot, text: str) -> Update:
+    return Update.de_json({
+        "update_id": random.randint(1, 10 ** 9),
+        "message": {
+            "message_id": random.randint(1, 10 ** 6), "date": int(time.time()), "chat": CHAT, "from": USER,
+            "text": text, "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    }, bot)
+
+
+def callback_update(bot, data: str, message_id: int) -> Update:
+    return Update.de_json({
+        "update_id": random.randint(1, 10 ** 9),
+        "callback_query": {
+            "id": str(random.randint(1, 10 ** 9)), "from": USER, "chat_instance": "bench", "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": CHAT, "from": USER,
+                        "text": "quiz"},
+        },
+    }, bot)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+
+def summary(values: list) -> str:
+    return (f"p50={percentile(values, 50) * 1000:8.1f} ms  p95={percentile(values, 95) * 1000:8.1f} ms  "
+            f"p99={percentile(values, 99) * 1000:8.1f} ms  (n={len(values)})")
+
+
+def fresh_state():
+    main.state_store = main.MemoryStateBackend()
+    main.translation_cache = main.TranslationCache("", main.TRANSLATION_CACHE_SIZE, 0)
+    for chat_id in list(main.quiz_translation_tasks):
+        main.cancel_speculative_translations(chat_id)
+
+
+async def timed_quiz(app) -> float:
+    update = command_update(app.bot, "/quiz")
+    started = time.perf_counter()
+    await main.quiz(update, CallbackContext.from_update(update, app))
+    return time.perf_counter() - started
+
+
+async def bench_quiz(app, runs: int, pool_hit: bool) -> list:
+    pool = main.sentence_pool
+    pool.depth = runs if pool_hit else 0
+    if pool_hit:
+        pool.ensure_refill()
+        while len(pool) < runs:
+            await asyncio.sleep(0.01)
+    latencies = []
+    for _ in range(runs):
+        latencies.append(await timed_quiz(app))
+    pool.depth = 0
+    await pool.stop()
+    return latencies
+
+
+async def bench_clicks(app, deepseek: FakeDeepSeek, chat_count: int, clicks: int, speculative_wait: float):
+    main.TARGET_CHATS = [
+        ((i + 2) if i % 2 else -(i + 2), f"Student_{i + 1}", ["ru", "es"] if i % 3 else ["es", "fr"])
+        for i in range(chat_count)
+    ]
+    fresh_state()
+    main.sentence_pool.depth = 0
+    latencies = []
+    ack_latencies = []
+    click_calls = []
+    quiz_calls = []
+    for _ in range(clicks):
+        before_quiz = deepseek.calls["translate"]
+        await timed_quiz(app)
+        await asyncio.sleep(speculative_wait)
+        session = main.state_store.get_quiz(TEACHER_CHAT_ID)
+        update = callback_update(app.bot, "send_0", session["message_id"])
+        before_click = deepseek.calls["translate"]
+        started = time.perf_counter()
+        await main.send_sentence(update, CallbackContext.from_update(update, app))
+        ack_latencies.append(time.perf_counter() - started)
+        # The callback returns once the deliveries are queued; time until the outbox has sent them
+        while not main.outbox.idle:
+            await asyncio.sleep(0.005)
+        latencies.append(time.perf_counter() - started)
+        click_calls.append(deepseek.calls["translate"] - before_click)
+        # Let speculative translations for the other sentences finish so they are counted
+        await asyncio.gather(*main.quiz_translation_tasks.get(TEACHER_CHAT_ID, []), return_exceptions=True)
+        quiz_calls.append(deepseek.calls["translate"] - before_quiz)
+    return latencies, ack_latencies, click_calls, quiz_calls
+
+
+async def bench_reminders(app, runs: int) -> list:
+    latencies = []
+    for i in range(runs):
+        context = SimpleNamespace(bot=app.bot, job=SimpleNamespace(chat_id=TEACHER_CHAT_ID + 1 + i))
+        started = time.perf_counter()
+        await main.send_reminder(context)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def run(args) -> str:
+    deepseek = FakeDeepSeek(args.llm_latency, args.llm_jitter, args.llm_error_rate)
+    telegram = FakeTelegram(args.tg_latency, args.flood_rate, args.retry_after)
+    ds_server, ds_port = await start_http_server(deepseek.handle)
+    tg_server, tg_port = await start_http_server(telegram.handle)
+    main.DEEPSEEK_URL = f"http://127.0.0.1:{ds_port}/v1/chat/completions"
+
+    app = Application.builder().token(os.environ["TELEGRAM_BOT_TOKEN"]) \
+        .base_url(f"http://127.0.0.1:{tg_port}/bot").updater(None).build()
+    await app.initialize()
+    await main.outbox.start(app.bot)
+
+    lines = [
+        "Bench settings: "
+        f"llm_latency={args.llm_latency}s±{args.llm_jitter}s llm_error_rate={args.llm_error_rate} "
+        f"tg_latency={args.tg_latency}s flood_rate={args.flood_rate} retry_after={args.retry_after}s",
+        "",
+    ]
+    try:
+        main.TARGET_CHATS = [(2, "Student_1", ["ru"])]
+        fresh_state()
+        lines.append(f"/quiz (pool hit)         {summary(await bench_quiz(app, args.quiz_runs, True))}")
+        fresh_state()
+        mode = "streamed" if main.DEEPSEEK_STREAM else "blocking"
+        lines.append(f"/quiz (live, {mode:8}) {summary(await bench_quiz(app, args.quiz_runs, False))}")
+        lines.append("")
+
+        lines.append("Click fan-out (click to last delivery; ack = callback returns; "
+                     "translate_calls/quiz includes speculative work):")
+        for chat_count in args.chat_counts:
+            latencies, ack_latencies, click_calls, quiz_calls = await bench_clicks(
+                app, deepseek, chat_count, args.clicks, args.speculative_wait
+            )
+            lines.append(f"  {chat_count:4d} chats  {summary(latencies)}  "
+                         f"ack p50={percentile(ack_latencies, 50) * 1000:.1f} ms  "
+                         f"llm_calls/click={sum(click_calls) / len(click_calls):.2f}  "
+                         f"translate_calls/quiz={sum(quiz_calls) / len(quiz_calls):.2f}")
+        lines.append("")
+
+        lines.append(f"send_reminder            {summary(await bench_reminders(app, args.reminder_runs))}")
+        lines.append("")
+        lines.append(f"DeepSeek calls: {deepseek.calls}")
+        lines.append(f"Telegram calls: {dict(sorted(telegram.calls.items()))} flood_waits={telegram.flood_waits}")
+        lines.append(f"Translation cache: {main.translation_cache.stats()}")
+    finally:
+        fresh_state()
+        await main.outbox.stop()
+        await app.shutdown()
+        await main.close_deepseek_client()
+        ds_server.close()
+        tg_server.close()
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quiz-runs", type=int, default=20)
+    parser.add_argument("--clicks", type=int, default=3, help="clicks measured per chat count")
+    parser.add_argument("--chat-counts", type=lambda v: [int(x) for x in v.split(",")], default=[1, 10, 50, 100])
+    parser.add_argument("--reminder-runs", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="mean DeepSeek latency, seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.2)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--tg-latency", type=float, default=0.03, help="Bot API latency, seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of fan-out sends answered 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--speculative-wait", type=float, default=0.0,
+                        help="pause between showing a quiz and clicking, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def bench_main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    main.logger.setLevel("WARNING")
+    logging.getLogger("httpx").setLevel("WARNING")
+    report = asyncio.run(run(args))
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(bench_main())
@@ -1,14 +1,25 @@
 import os
+import json
 import random
 import re
-import requests
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest, Forbidden, RetryAfter
 import logging
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
+import datetime
 import pytz
 import asyncio
+import contextlib
+import copy
+import contextvars
+import functools
+import heapq
+import hmac
+import signal
+import sqlite3
+import time
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -22,6 +33,94 @@ REMINDER_CHAT_ID = os.getenv("REMINDER_CHAT_ID")
 DEEPSEEK_URL = "https://api.deepseek.com/v1/chat/completions"
 DEEPSEEK_MODEL = "deepseek-chat"
 
+# DeepSeek HTTP client tuning (one pooled keep-alive client shared by all handlers)
+DEEPSEEK_TIMEOUT = float(os.getenv("DEEPSEEK_TIMEOUT", "60"))
+DEEPSEEK_CONNECT_TIMEOUT = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "10"))
+DEEPSEEK_MAX_CONNECTIONS = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "20"))
+DEEPSEEK_MAX_KEEPALIVE = int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "10"))
+DEEPSEEK_KEEPALIVE_EXPIRY = float(os.getenv("DEEPSEEK_KEEPALIVE_EXPIRY", "30"))
+
+# DeepSeek resilience: per-operation deadlines ("operation:seconds,..."; others use
+# DEEPSEEK_TIMEOUT), retries with jittered backoff on 429/5xx, hedging and a circuit breaker
+DEEPSEEK_DEADLINES = {
+    op: float(sec) for op, sec in (
+        entry.split(":", 1) for entry in
+        os.getenv("DEEPSEEK_DEADLINES", "generate:45,generate_stream:60,repair:20,translate:15,translate_batch:20").split(",")
+        if ":" in entry
+    )
+}
+DEEPSEEK_MAX_RETRIES = int(os.getenv("DEEPSEEK_MAX_RETRIES", "2"))
+DEEPSEEK_BACKOFF_BASE = float(os.getenv("DEEPSEEK_BACKOFF_BASE", "0.5"))
+DEEPSEEK_BACKOFF_MAX = float(os.getenv("DEEPSEEK_BACKOFF_MAX", "8"))
+DEEPSEEK_HEDGE = os.getenv("DEEPSEEK_HEDGE", "1") == "1"  # second request once an attempt passes p95
+DEEPSEEK_HEDGE_MIN_SAMPLES = int(os.getenv("DEEPSEEK_HEDGE_MIN_SAMPLES", "20"))
+DEEPSEEK_BREAKER_FAILURES = int(os.getenv("DEEPSEEK_BREAKER_FAILURES", "5"))
+DEEPSEEK_BREAKER_RESET = float(os.getenv("DEEPSEEK_BREAKER_RESET", "30"))  # seconds before a trial call
+
+# Translation cache: in-memory LRU backed by SQLite (empty path = memory only)
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH", "translation_cache.sqlite3")
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "5000"))
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", "0"))  # seconds, 0 = never expire
+# Micro-batching: distinct translations requested within the wait window share one completion
+TRANSLATION_BATCH_SIZE = int(os.getenv("TRANSLATION_BATCH_SIZE", "8"))  # (sentence, language) pairs
+TRANSLATION_BATCH_WAIT = float(os.getenv("TRANSLATION_BATCH_WAIT_MS", "10")) / 1000
+
+# Telegram send limits (messages per second unless noted)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE_PER_MIN = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MIN", "20"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+
+# Pre-generated sentence batches so /quiz can answer without waiting for DeepSeek
+QUIZ_SIZE = 6
+SENTENCE_POOL_DEPTH = int(os.getenv("SENTENCE_POOL_DEPTH", "3"))
+SENTENCE_POOL_LOW_WATER = int(os.getenv("SENTENCE_POOL_LOW_WATER", "1"))
+SENTENCE_POOL_PATH = os.getenv("SENTENCE_POOL_PATH", "sentence_pool.json")
+# Rounds of per-sentence repair calls for generated sentences that break the prompt's rules
+GENERATION_REPAIR_ROUNDS = int(os.getenv("GENERATION_REPAIR_ROUNDS", "2"))
+
+# Max speculative translations running at once across all open quizzes
+SPECULATIVE_CONCURRENCY = int(os.getenv("SPECULATIVE_CONCURRENCY", "6"))
+
+# Quiz sessions and topic history: "memory" or "sqlite" (survives restarts)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.sqlite3")
+QUIZ_TTL = int(os.getenv("QUIZ_TTL", "30"))  # seconds a quiz keyboard stays active
+
+# Durable outbox for sentence deliveries (empty path = memory only) and its worker pool
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.sqlite3")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", "86400"))  # seconds finished deliveries are kept
+
+# Stream batch generation so sentences appear on the keyboard as they are written
+DEEPSEEK_STREAM = os.getenv("DEEPSEEK_STREAM", "1") == "1"
+
+# Quiz status message: edits (streamed keyboard, sent counter) are coalesced to at most
+# one per STATUS_EDIT_INTERVAL, and with FOLD_CONFIRMATIONS=1 delivery confirmations
+# become lines of that message.
+STATUS_EDIT_INTERVAL = float(os.getenv("STATUS_EDIT_INTERVAL", "1.0"))
+FOLD_CONFIRMATIONS = os.getenv("FOLD_CONFIRMATIONS", "1") == "1"
+STATUS_MAX_NOTES = int(os.getenv("STATUS_MAX_NOTES", "3"))  # confirmation lines kept under the header
+
+# Prometheus metrics endpoint (METRICS_PORT=0 disables) and per-update trace log
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+TRACE_UPDATES = os.getenv("TRACE_UPDATES", "0") == "1"
+
+# How updates arrive: "polling" (default) or "webhook" via the embedded HTTP server.
+# WEBHOOK_URL is the public base URL registered with Telegram; leave it empty to
+# skip set_webhook (e.g. when testing locally by POSTing recorded updates).
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+HTTP_MAX_BODY = int(os.getenv("HTTP_MAX_BODY", str(1024 * 1024)))  # larger requests get 413
+
 # --- TARGET CHATS CONFIGURATION ---
 TARGET_CHATS = []
 
@@ -44,12 +143,298 @@ try:
 except (ValueError, TypeError):
     pass
 
+# --- REMINDER SCHEDULE ---
+# REMINDER_CONFIG="chat_id:HH:MM+HH:MM@Timezone,..." e.g.
+# REMINDER_CONFIG=123456789:10:00+16:00@Asia/Jerusalem,-987654321:09:30
+# Timezone defaults to UTC. REMINDER_CHAT_ID alone keeps the 10:00 + 16:00 UTC schedule.
+REMINDER_TARGETS = []
+
+env_reminder_config = os.getenv("REMINDER_CONFIG", "")
+if env_reminder_config:
+    try:
+        for entry in env_reminder_config.split(","):
+            if ":" not in entry:
+                continue
+            chat_id_str, schedule = entry.split(":", 1)
+            times_str, _, tz_name = schedule.partition("@")
+            tz = pytz.timezone(tz_name.strip()) if tz_name.strip() else pytz.utc
+            times = []
+            for t in times_str.split("+"):
+                hour, minute = t.strip().split(":")
+                times.append(datetime.time(int(hour), int(minute), tzinfo=tz))
+            REMINDER_TARGETS.append((int(chat_id_str.strip()), times))
+    except (ValueError, TypeError, pytz.UnknownTimeZoneError) as e:
+        logging.getLogger(__name__).error(f"Error parsing REMINDER_CONFIG: {e}")
+
+if REMINDER_CHAT_ID and not REMINDER_TARGETS:
+    REMINDER_TARGETS.append((REMINDER_CHAT_ID, [
+        datetime.time(10, 0, tzinfo=pytz.utc),
+        datetime.time(16, 0, tzinfo=pytz.utc),
+    ]))
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# --- Metrics ---
+# Minimal Prometheus-format metrics kept in process; served by start_metrics_server.
+_metrics = []
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)  # str so mixed int/str labels still sort
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # label key -> [bucket counts..., sum, count]
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)  # str so mixed int/str labels still sort
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+class CallbackGauge:
+    """Gauge whose value is read from `fn()` at scrape time."""
+
+    def __init__(self, name: str, help_text: str, fn):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        _metrics.append(self)
+
+    def render(self) -> list:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+# Spans recorded while handling the current update (only when TRACE_UPDATES is on)
+_trace_spans = contextvars.ContextVar("trace_spans", default=None)
+
+
+class _Timer:
+    """Context manager that observes elapsed time into a histogram and the update trace."""
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        self.histogram.observe(elapsed, **self.labels)
+        spans = _trace_spans.get()
+        if spans is not None:
+            label = ",".join(str(v) for v in self.labels.values())
+            spans.append((f"{self.histogram.name}[{label}]" if label else self.histogram.name, elapsed))
+        return False
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+DEEPSEEK_SECONDS = Histogram("deepseek_request_seconds", "DeepSeek request latency", ("operation",))
+DEEPSEEK_ERRORS = Counter("deepseek_errors_total", "Failed DeepSeek requests", ("operation", "status"))
+DEEPSEEK_TOKENS = Counter("deepseek_tokens_total", "Tokens reported in DeepSeek usage", ("operation", "kind"))
+PARSE_SECONDS = Histogram("sentence_parse_seconds", "Time spent parsing numbered sentences",
+                          buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05))
+TRANSLATION_SECONDS = Histogram("translation_seconds", "End-to-end translation latency", ("mode",))
+TELEGRAM_SEND_SECONDS = Histogram("telegram_send_seconds", "Bot API send_message latency")
+TELEGRAM_SEND_ERRORS = Counter("telegram_send_errors_total", "Failed Bot API sends", ("error",))
+HANDLER_SECONDS = Histogram("update_handler_seconds", "Update handler latency", ("handler",))
+GENERATION_REJECTS = Counter("generated_sentence_rejects_total", "Generated sentences failing validation",
+                             ("reason",))
+GENERATION_FALLBACKS = Counter("generated_sentence_fallbacks_total",
+                               "Slots filled with a fallback sentence after repair rounds ran out")
+COALESCED_REQUESTS = Counter("coalesced_requests_total", "Calls that joined an identical in-flight call",
+                             ("flight",))
+TRANSLATION_BATCH_ITEMS = Histogram("translation_batch_items", "Translations sent per batched completion",
+                                    buckets=(1, 2, 4, 8, 16, 32))
+TRANSLATION_CACHE_HITS = Counter("translation_cache_hits_total", "Translation cache hits")
+TRANSLATION_CACHE_MISSES = Counter("translation_cache_misses_total", "Translation cache misses")
+EVENT_LOOP_LAG = Histogram("event_loop_lag_seconds", "How late a 0.5 s event loop tick fires",
+                           buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+
+def record_deepseek_usage(operation: str, usage: dict):
+    if not usage:
+        return
+    # prompt_cache_hit/miss_tokens split prompt_tokens by DeepSeek's prefix (context) cache
+    for field, kind in (("prompt_tokens", "prompt"), ("completion_tokens", "completion"),
+                        ("prompt_cache_hit_tokens", "cache_hit"), ("prompt_cache_miss_tokens", "cache_miss")):
+        if usage.get(field):
+            DEEPSEEK_TOKENS.inc(usage[field], operation=operation, kind=kind)
+
+
+def instrumented(handler):
+    """Wrap a PTB handler to time it and, with TRACE_UPDATES=1, log a per-update span breakdown."""
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        token = _trace_spans.set([]) if TRACE_UPDATES else None
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, handler=handler.__name__)
+            if token is not None:
+                spans = _trace_spans.get()
+                _trace_spans.reset(token)
+                breakdown = " | ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in spans)
+                logger.info(f"Trace update {update.update_id} ({handler.__name__}): "
+                            f"{elapsed * 1000:.0f}ms total | {breakdown}")
+
+    return wrapper
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+async def start_http_server(handler, host: str, port: int, max_body: int = HTTP_MAX_BODY):
+    """Tiny HTTP/1.1 server: `handler(method, path, headers, body)` -> (status, content_type, body).
+
+    A bytes body is sent with Content-Length, an async iterator of bytes with
+    chunked transfer encoding. Requests declaring more than `max_body` bytes
+    get 413 and the connection is closed without reading them.
+    """
+
+    def head(status, content_type, framing, extra=""):
+        return (f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                f"Content-Type: {content_type}\r\n{framing}\r\n{extra}\r\n").encode()
+
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length < 0:
+                    raise ValueError(f"bad Content-Length {length}")
+                if length > max_body:
+                    logger.warning(f"HTTP {method} {path}: {length}-byte body over the {max_body}-byte limit")
+                    payload = b"request body too large"
+                    writer.write(head(413, "text/plain", f"Content-Length: {len(payload)}", "Connection: close\r\n")
+                                 + payload)
+                    await writer.drain()
+                    break
+                body = await reader.readexactly(length)
+                try:
+                    status, content_type, payload = await handler(method, path, headers, body)
+                except Exception as e:
+                    logger.error(f"HTTP handler error for {method} {path}: {e}")
+                    status, content_type, payload = 500, "text/plain", b"internal error"
+                if isinstance(payload, bytes):
+                    writer.write(head(status, content_type, f"Content-Length: {len(payload)}") + payload)
+                else:
+                    writer.write(head(status, content_type, "Transfer-Encoding: chunked"))
+                    try:
+                        async for chunk in payload:
+                            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                            await writer.drain()
+                    except ConnectionError:
+                        raise
+                    except Exception as e:
+                        # Headers are already out, so the only way to signal failure is a cut-off stream
+                        logger.error(f"HTTP stream error for {method} {path}: {e}")
+                        break
+                    writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass  # the loop is shutting down mid-request; nobody is left to report it to
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
+
+
+async def _metrics_handler(method: str, path: str, headers: dict, body: bytes):
+    if method == "GET" and path.split("?", 1)[0] == "/metrics":
+        return 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics().encode()
+    return 404, "text/plain", b"not found"
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    server = await start_http_server(_metrics_handler, host, port)
+    logger.info(f"📊 Metrics on http://{host}:{server.sockets[0].getsockname()[1]}/metrics")
+    return server
+
 # --- Grammar Structures (narrowed to Elena's current focus) ---
 # Conditionals 1/2/3, wish (present + past regret), modals of speculation
 # (past + present), comparatives (not quite as / not nearly as),
@@ -69,6 +454,23 @@ GRAMMAR_STRUCTURES = [
     "The sooner the better: We should book the tickets — the sooner the better.",
 ]
 
+# Russian construction each structure must show (regex on the lowercased
+# sentence), index-aligned with GRAMMAR_STRUCTURES.
+GRAMMAR_MARKERS = [
+    r"\bесли\b(?!.*\bбы\b)",                                    # 1st cond: если, no бы
+    r"\bесли бы\b",                                              # 2nd cond
+    r"\bесли бы\b",                                              # 3rd cond
+    r"\bжаль\b|\bхотел[аи]? бы\b",                               # wish (present)
+    r"\bжаль\b|\bхотел[аи]? бы\b",                               # wish (past)
+    r"\bнаверное\b|\bдолжно быть\b",                             # must have
+    r"\bвозможно\b|\bможет быть\b",                              # might have
+    r"\bнаверное\b|\bдолжно быть\b",                             # must (present)
+    r"\bвозможно\b|\bможет быть\b",                              # might (present)
+    r"\bне так(ой|ая|ое|ие)\b.*\bкак\b",                          # not quite as
+    r"\b(совсем|далеко) не так(ой|ая|ое|ие)\b.*\bкак\b",           # not nearly as
+    r"\bчем\b.*\bтем\b",                                         # the sooner the better
+]
+
 # --- Topics as NOUN PHRASES — kept simple and everyday for Elena (A2) ---
 TOPIC_CATEGORIES = [
     # Food & Cooking — very basic
@@ -97,80 +499,586 @@ TOPIC_CATEGORIES = [
      "a cold", "running", "the gym", "a long walk", "good food"],
 ]
 
-recent_topics_used = []
 MAX_RECENT = 30
+GRAMMAR_HISTORY = int(os.getenv("GRAMMAR_HISTORY", "60"))  # recent structure uses counted per chat
+GRAMMAR_WEIGHTING = os.getenv("GRAMMAR_WEIGHTING", "least_seen")  # least_seen | uniform
+ROTATION_MAX_CHATS = int(os.getenv("ROTATION_MAX_CHATS", "10000"))  # chat histories kept in memory
+
+
+def _lazy_permutation(n: int):
+    """Yield range(n) in random order, paying only for the items actually consumed."""
+    swapped = {}
+    for i in range(n):
+        j = random.randrange(i, n)
+        yield swapped.get(j, j)
+        swapped[j] = swapped.get(i, i)
+
+
+class _UsageLevels:
+    """Item indices grouped by usage count, so the least-used k come out in O(k)."""
+
+    def __init__(self, n: int):
+        self.levels = {0: list(range(n))}
+        self.level_of = [0] * n
+        self.pos = list(range(n))
+
+    def move(self, i: int, delta: int):
+        level = self.level_of[i]
+        bucket = self.levels[level]
+        last = bucket[-1]
+        bucket[self.pos[i]] = last
+        self.pos[last] = self.pos[i]
+        bucket.pop()
+        if not bucket:
+            del self.levels[level]
+        target = self.levels.setdefault(level + delta, [])
+        self.pos[i] = len(target)
+        target.append(i)
+        self.level_of[i] = level + delta
+
+    def least_used(self, k: int) -> list:
+        picked = []
+        for level in sorted(self.levels):
+            need = k - len(picked)
+            if need <= 0:
+                break
+            bucket = self.levels[level]
+            picked.extend(random.sample(bucket, min(need, len(bucket))))
+        return picked
+
+
+class _ChatRotation:
+    """One chat's recent topics (deque + set) and recent grammar usage."""
+
+    def __init__(self, n_structures: int, topic_ids: list, grammar_ids: list):
+        self.recent = deque(maxlen=MAX_RECENT)
+        self.recent_set = set()
+        self.grammar_recent = deque()
+        self.grammar_levels = _UsageLevels(n_structures)
+        for t in topic_ids:
+            self.add_topic(t)
+        for g in grammar_ids:
+            self.add_grammar(g)
+
+    def add_topic(self, t: int):
+        if t in self.recent_set:
+            return
+        if len(self.recent) == self.recent.maxlen:
+            self.recent_set.discard(self.recent[0])
+        self.recent.append(t)
+        self.recent_set.add(t)
+
+    def clear_topics(self):
+        self.recent.clear()
+        self.recent_set.clear()
+
+    def add_grammar(self, g: int):
+        self.grammar_recent.append(g)
+        self.grammar_levels.move(g, +1)
+        if len(self.grammar_recent) > GRAMMAR_HISTORY:
+            self.grammar_levels.move(self.grammar_recent.popleft(), -1)
+
+
+class RotationEngine:
+    """Per-chat topic and grammar rotation over precomputed catalogue indexes.
+
+    Topics are drawn from different categories first, skipping each chat's
+    MAX_RECENT most recent ones; grammar structures favour those the chat has
+    used least over its last GRAMMAR_HISTORY picks. Both selections cost
+    O(k) expected time regardless of catalogue size. Histories are loaded from
+    and saved to `state_store` under "chat:<id>" / "grammar:<id>" keys
+    ("global" / "grammar:global" when no chat is given).
+    """
+
+    _ATTEMPTS = 8
+
+    def __init__(self, categories: list, structures: list, weighting: str = GRAMMAR_WEIGHTING,
+                 max_chats: int = ROTATION_MAX_CHATS):
+        self.topics = list(dict.fromkeys(t for cat in categories for t in cat))
+        self.topic_index = {t: i for i, t in enumerate(self.topics)}
+        self.categories = [[self.topic_index[t] for t in dict.fromkeys(cat)] for cat in categories if cat]
+        self.structures = list(structures)
+        self.structure_index = {g: i for i, g in enumerate(self.structures)}
+        self.weighting = weighting
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+
+    @staticmethod
+    def _keys(chat_id):
+        suffix = "global" if chat_id is None else str(chat_id)
+        topic_key = "global" if chat_id is None else f"chat:{chat_id}"
+        return topic_key, f"grammar:{suffix}"
+
+    def _chat(self, chat_id) -> _ChatRotation:
+        state = self._chats.get(chat_id)
+        if state is None:
+            topic_key, grammar_key = self._keys(chat_id)
+            topic_ids = [self.topic_index[t] for t in state_store.get_topic_history(topic_key)
+                         if t in self.topic_index]
+            grammar_ids = [self.structure_index[g] for g in state_store.get_topic_history(grammar_key)
+                           if g in self.structure_index]
+            state = self._chats[chat_id] = _ChatRotation(len(self.structures), topic_ids, grammar_ids)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return state
+
+    def _save(self, chat_id, state: _ChatRotation):
+        topic_key, grammar_key = self._keys(chat_id)
+        state_store.set_topic_history(topic_key, [self.topics[t] for t in state.recent])
+        state_store.set_topic_history(grammar_key, [self.structures[g] for g in state.grammar_recent])
+
+    def _draw(self, candidates: list, state: _ChatRotation, picked: set):
+        for _ in range(self._ATTEMPTS):
+            t = random.choice(candidates)
+            if t not in state.recent_set and t not in picked:
+                return t
+        return None
+
+    def pick_topics(self, n: int, chat_id=None) -> list:
+        state = self._chat(chat_id)
+        picked = {}  # insertion-ordered set
+
+        for c in _lazy_permutation(len(self.categories)):
+            if len(picked) >= n:
+                break
+            t = self._draw(self.categories[c], state, picked)
+            if t is not None:
+                picked[t] = None
+
+        for _ in range(self._ATTEMPTS * (n - len(picked))):
+            if len(picked) >= n:
+                break
+            t = self._draw(range(len(self.topics)), state, picked)
+            if t is not None:
+                picked[t] = None
+
+        if len(picked) < n:
+            # Rejection sampling kept missing: fall back to a full scan, resetting history if exhausted
+            available = [t for t in range(len(self.topics)) if t not in state.recent_set and t not in picked]
+            if len(available) < n - len(picked):
+                state.clear_topics()
+                available = [t for t in range(len(self.topics)) if t not in picked]
+            for t in random.sample(available, min(n - len(picked), len(available))):
+                picked[t] = None
+
+        for t in picked:
+            state.add_topic(t)
+        self._save(chat_id, state)
+        return [self.topics[t] for t in picked]
+
+    def remember_topics(self, topics: list, chat_id=None):
+        state = self._chat(chat_id)
+        for t in topics:
+            if t in self.topic_index:
+                state.add_topic(self.topic_index[t])
+        self._save(chat_id, state)
+
+    def pick_grammar(self, n: int, chat_id=None) -> list:
+        state = self._chat(chat_id)
+        n = min(n, len(self.structures))
+        if self.weighting == "uniform":
+            picked = random.sample(range(len(self.structures)), n)
+        else:
+            picked = state.grammar_levels.least_used(n)
+            random.shuffle(picked)
+        for g in picked:
+            state.add_grammar(g)
+        self._save(chat_id, state)
+        return [self.structures[g] for g in picked]
 
+    def remember_grammar(self, structures: list, chat_id=None):
+        state = self._chat(chat_id)
+        for g in structures:
+            if g in self.structure_index:
+                state.add_grammar(self.structure_index[g])
+        self._save(chat_id, state)
 
-def get_unique_topics(n: int) -> list:
+    def score_batch(self, topics: list, structures: list, chat_id=None) -> tuple:
+        """(topics the chat saw recently, recent uses of the batch's grammar) for a ready-made batch."""
+        state = self._chat(chat_id)
+        seen = sum(1 for t in topics if self.topic_index.get(t) in state.recent_set)
+        usage = sum(state.grammar_levels.level_of[self.structure_index[g]]
+                    for g in structures if g in self.structure_index)
+        return seen, usage
+
+
+rotation = RotationEngine(TOPIC_CATEGORIES, GRAMMAR_STRUCTURES)
+
+
+def get_unique_topics(n: int, chat_id=None) -> list:
     """Pick N topics that haven't been used recently, preferring different categories."""
-    available_by_cat = [
-        [t for t in cat if t not in recent_topics_used]
-        for cat in TOPIC_CATEGORIES
-    ]
-    available_by_cat = [cat for cat in available_by_cat if cat]
-
-    picked = []
-    random.shuffle(available_by_cat)
-    for cat in available_by_cat:
-        if len(picked) >= n:
-            break
-        picked.append(random.choice(cat))
+    return rotation.pick_topics(n, chat_id)
 
-    if len(picked) < n:
-        all_available = [t for cat in TOPIC_CATEGORIES for t in cat
-                         if t not in recent_topics_used and t not in picked]
-        if len(all_available) < (n - len(picked)):
-            recent_topics_used.clear()
-            all_available = [t for cat in TOPIC_CATEGORIES for t in cat if t not in picked]
-        picked.extend(random.sample(all_available, n - len(picked)))
 
-    for t in picked:
-        recent_topics_used.append(t)
-    while len(recent_topics_used) > MAX_RECENT:
-        recent_topics_used.pop(0)
+def remember_topics(topics: list, chat_id=None):
+    """Record topics as recently used so get_unique_topics avoids them."""
+    rotation.remember_topics(topics, chat_id)
 
-    return picked
 
+def pick_grammar_structures(n: int, chat_id=None) -> list:
+    """Pick N grammar structures, favouring those the chat has seen least."""
+    return rotation.pick_grammar(n, chat_id)
 
-def _call_deepseek(prompt: str, temperature: float = 0.8, max_tokens: int = 600) -> str:
-    """Call DeepSeek chat completions and return the assistant text."""
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
+
+_deepseek_client = None
+
+
+def _get_deepseek_client() -> httpx.AsyncClient:
+    """Return the shared DeepSeek client, creating it on first use."""
+    global _deepseek_client
+    if _deepseek_client is None or _deepseek_client.is_closed:
+        _deepseek_client = httpx.AsyncClient(
+            headers={
+                "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            timeout=httpx.Timeout(DEEPSEEK_TIMEOUT, connect=DEEPSEEK_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=DEEPSEEK_MAX_CONNECTIONS,
+                max_keepalive_connections=DEEPSEEK_MAX_KEEPALIVE,
+                keepalive_expiry=DEEPSEEK_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _deepseek_client
+
+
+async def close_deepseek_client():
+    global _deepseek_client
+    if _deepseek_client is not None:
+        await _deepseek_client.aclose()
+        _deepseek_client = None
+
+
+# --- DeepSeek resilience ---
+class DeepSeekError(Exception):
+    """A failed DeepSeek call; `status` is the HTTP status, or None for transport errors and deadlines."""
+
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class CircuitOpenError(DeepSeekError):
+    @property
+    def retryable(self) -> bool:
+        return False
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failed calls; after `reset_timeout` one trial call may pass.
+
+    Only retryable errors (transport, deadline, 429, 5xx) count as failures.
+    """
+
+    def __init__(self, failure_threshold: int = DEEPSEEK_BREAKER_FAILURES,
+                 reset_timeout: float = DEEPSEEK_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        # Half-open: let one trial through (another one if the last trial never reported back)
+        if self._trial_started is None or now - self._trial_started >= self.reset_timeout:
+            self._trial_started = now
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("DeepSeek circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None and self._trial_started is None:
+            return  # a call from before the circuit opened; don't extend the open window
+        if self._trial_started is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"DeepSeek circuit open for {self.reset_timeout}s after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self._trial_started = None
+
+    def record_error(self, error: DeepSeekError):
+        """Count a retryable error as a failure; a 4xx reply still shows DeepSeek is up."""
+        if error.retryable:
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+class LatencyTracker:
+    """Recent successful latencies per operation, used to decide when to hedge."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples = {}
+
+    def record(self, operation: str, seconds: float):
+        self._samples.setdefault(operation, deque(maxlen=self.window)).append(seconds)
+
+    def p95(self, operation: str):
+        samples = self._samples.get(operation)
+        if not samples or len(samples) < DEEPSEEK_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+deepseek_breaker = CircuitBreaker()
+deepseek_latency = LatencyTracker()
+DEEPSEEK_RETRIES = Counter("deepseek_retries_total", "DeepSeek retry attempts", ("operation",))
+DEEPSEEK_HEDGES = Counter("deepseek_hedged_requests_total", "Hedged second DeepSeek requests", ("operation",))
+CallbackGauge("deepseek_circuit_open", "1 while the DeepSeek circuit breaker is open",
+              lambda: int(deepseek_breaker.state != "closed"))
+
+
+def _deadline_for(operation: str) -> float:
+    return DEEPSEEK_DEADLINES.get(operation, DEEPSEEK_TIMEOUT)
+
+
+def _backoff_delay(attempt: int, error: DeepSeekError) -> float:
+    delay = random.uniform(0, min(DEEPSEEK_BACKOFF_MAX, DEEPSEEK_BACKOFF_BASE * 2 ** attempt))
+    if error.retry_after:
+        delay = max(delay, error.retry_after)
+    return delay
+
+
+def _retry_after_seconds(res: httpx.Response):
+    try:
+        return float(res.headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+
+async def _post_deepseek(payload: dict, operation: str) -> dict:
+    """One DeepSeek HTTP request; raises DeepSeekError on transport errors and non-200 replies."""
+    started = time.perf_counter()
+    with DEEPSEEK_SECONDS.time(operation=operation):
+        try:
+            res = await _get_deepseek_client().post(DEEPSEEK_URL, json=payload)
+        except httpx.HTTPError as e:
+            DEEPSEEK_ERRORS.inc(operation=operation, status=type(e).__name__)
+            raise DeepSeekError(f"DeepSeek request failed: {type(e).__name__}: {e}") from e
+    if res.status_code != 200:
+        DEEPSEEK_ERRORS.inc(operation=operation, status=res.status_code)
+        logger.error(f"DeepSeek error: {res.status_code} - {res.text}")
+        raise DeepSeekError(f"DeepSeek returned {res.status_code}", res.status_code, _retry_after_seconds(res))
+    deepseek_latency.record(operation, time.perf_counter() - started)
+    return res.json()
+
+
+async def _hedged_post(payload: dict, operation: str, timeout: float) -> dict:
+    """Post once; if that runs past the recent p95, race a second identical request."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    tasks = {asyncio.create_task(_post_deepseek(payload, operation))}
+    hedge_after = deepseek_latency.p95(operation) if DEEPSEEK_HEDGE else None
+    last_error = None
+    try:
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                DEEPSEEK_HEDGES.inc(operation=operation)
+                logger.info(f"DeepSeek {operation} slower than p95 ({hedge_after:.2f}s), hedging")
+                tasks.add(asyncio.create_task(_post_deepseek(payload, operation)))
+        while tasks:
+            remaining = deadline - loop.time()
+            done, _ = await asyncio.wait(tasks, timeout=max(0.0, remaining), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                DEEPSEEK_ERRORS.inc(operation=operation, status="deadline")
+                raise DeepSeekError(f"DeepSeek {operation} exceeded its {_deadline_for(operation)}s deadline")
+            for task in done:
+                tasks.discard(task)
+                if task.exception() is None:
+                    return task.result()
+                last_error = task.exception()
+        raise last_error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _messages(prompt: str, system: str = None) -> list:
+    messages = [{"role": "system", "content": system}] if system else []
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+async def _call_deepseek(prompt: str, temperature: float = 0.8, max_tokens: int = 600,
+                         operation: str = "chat", system: str = None) -> str:
+    """Call DeepSeek chat completions and return the assistant text.
+
+    `system` is sent as a leading system message; keep it static so
+    DeepSeek's prefix cache can reuse it and only `prompt` varies.
+
+    The whole call, retries included, must finish within the operation's
+    deadline. 429/5xx and transport errors are retried with jittered
+    exponential backoff; while the circuit breaker is open the call fails
+    immediately with CircuitOpenError so callers go straight to fallbacks.
+    """
+    if not deepseek_breaker.allow():
+        DEEPSEEK_ERRORS.inc(operation=operation, status="circuit_open")
+        raise CircuitOpenError("DeepSeek circuit is open")
     payload = {
         "model": DEEPSEEK_MODEL,
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": _messages(prompt, system),
         "temperature": temperature,
         "max_tokens": max_tokens,
         "stream": False
     }
-    res = requests.post(DEEPSEEK_URL, headers=headers, json=payload, timeout=60)
-    if res.status_code != 200:
-        logger.error(f"DeepSeek error: {res.status_code} - {res.text}")
-        raise Exception(f"DeepSeek returned {res.status_code}")
-    data = res.json()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + _deadline_for(operation)
+    attempt = 0
+    while True:
+        try:
+            data = await _hedged_post(payload, operation, deadline - loop.time())
+            break
+        except DeepSeekError as e:
+            delay = _backoff_delay(attempt, e)
+            if not e.retryable or attempt >= DEEPSEEK_MAX_RETRIES or loop.time() + delay >= deadline:
+                deepseek_breaker.record_error(e)
+                raise
+            attempt += 1
+            DEEPSEEK_RETRIES.inc(operation=operation)
+            logger.warning(f"DeepSeek {operation} failed ({e}), retry {attempt} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+    deepseek_breaker.record_success()
+    record_deepseek_usage(operation, data.get("usage"))
     return data["choices"][0]["message"]["content"].strip()
 
 
-# --- BATCHED generation: all N sentences in ONE API call ---
-def generate_russian_sentences_batch(structures: list) -> list:
-    """Generate N Russian sentences in a single call. EASY level for Elena (A2)."""
-    n = len(structures)
-    topics = get_unique_topics(n)
+async def _open_deepseek_stream(payload: dict, operation: str, deadline: float):
+    """Yield raw SSE lines of one streamed request, failing once `deadline` (loop time) passes."""
+    loop = asyncio.get_running_loop()
+    try:
+        async with _get_deepseek_client().stream("POST", DEEPSEEK_URL, json=payload) as res:
+            if res.status_code != 200:
+                DEEPSEEK_ERRORS.inc(operation=operation, status=res.status_code)
+                body = (await res.aread()).decode(errors="replace")
+                logger.error(f"DeepSeek error: {res.status_code} - {body}")
+                raise DeepSeekError(f"DeepSeek returned {res.status_code}", res.status_code,
+                                    _retry_after_seconds(res))
+            lines = res.aiter_lines()
+            while True:
+                try:
+                    line = await asyncio.wait_for(lines.__anext__(), max(0.0, deadline - loop.time()))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    DEEPSEEK_ERRORS.inc(operation=operation, status="deadline")
+                    raise DeepSeekError(f"DeepSeek {operation} exceeded its {_deadline_for(operation)}s deadline")
+                yield line
+    except httpx.HTTPError as e:
+        DEEPSEEK_ERRORS.inc(operation=operation, status=type(e).__name__)
+        raise DeepSeekError(f"DeepSeek request failed: {type(e).__name__}: {e}") from e
+
+
+async def _stream_deepseek(prompt: str, temperature: float = 0.8, max_tokens: int = 600,
+                           operation: str = "stream", system: str = None):
+    """Stream DeepSeek chat completions, yielding content deltas as they arrive.
+
+    Uses the same deadline, breaker and retry policy as _call_deepseek; a
+    request is only retried if it failed before producing any content.
+    """
+    if not deepseek_breaker.allow():
+        DEEPSEEK_ERRORS.inc(operation=operation, status="circuit_open")
+        raise CircuitOpenError("DeepSeek circuit is open")
+    payload = {
+        "model": DEEPSEEK_MODEL,
+        "messages": _messages(prompt, system),
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True}
+    }
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + _deadline_for(operation)
+    attempt = 0
+    yielded = False
+    with DEEPSEEK_SECONDS.time(operation=operation):
+        while True:
+            try:
+                async with contextlib.aclosing(_open_deepseek_stream(payload, operation, deadline)) as lines:
+                    async for line in lines:
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        try:
+                            event = json.loads(data)
+                        except ValueError:
+                            continue
+                        record_deepseek_usage(operation, event.get("usage"))
+                        choices = event.get("choices") or [{}]
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            yielded = True
+                            yield delta
+                break
+            except DeepSeekError as e:
+                delay = _backoff_delay(attempt, e)
+                if (yielded or not e.retryable or attempt >= DEEPSEEK_MAX_RETRIES
+                        or loop.time() + delay >= deadline):
+                    deepseek_breaker.record_error(e)
+                    raise
+                attempt += 1
+                DEEPSEEK_RETRIES.inc(operation=operation)
+                logger.warning(f"DeepSeek {operation} failed ({e}), retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+    deepseek_breaker.record_success()
 
-    numbered_tasks = "\n".join(
-        f"{i+1}. TARGET GRAMMAR (must be the main clause): {s}\n"
-        f"   Topic (weave in naturally): {topics[i]}"
-        for i, s in enumerate(structures)
-    )
 
-    prompt = f"""You are writing SHORT, EASY Russian sentences for a real-beginner adult student (A2 level).
+# --- BATCHED generation: all N sentences in ONE API call ---
+def _parse_numbered_sentences(raw: str) -> list:
+    """Extract sentences from "1. ..." / "1) ..." lines of a model reply."""
+    with PARSE_SECONDS.time():
+        return _parse_numbered_lines(raw)
+
+
+def _parse_numbered_lines(raw: str) -> list:
+    sentences = []
+    for line in raw.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        m = re.match(r'^\s*\d+[.)]\s*(.+)$', line)
+        if m:
+            s = m.group(1).strip()
+            for bad in ['"', '«', '»', '*', '_']:
+                s = s.replace(bad, '')
+            sentences.append(s.strip())
+    return sentences
+
+
+# Static instructions sent as the system message of every generation call.
+# Keep all per-request text (structures, topics, counts) out of it so
+# DeepSeek's prefix cache can reuse it across calls.
+GENERATION_SYSTEM_PROMPT = """You are writing SHORT, EASY Russian sentences for a real-beginner adult student (A2 level).
 The student translates them into English to practise SPECIFIC English grammar.
-Recently she said the sentences feel too hard and complicated, so this round must feel FRIENDLY and DOABLE.
-
-TASKS:
-{numbered_tasks}
+Recently she said the sentences feel too hard and complicated, so every round must feel FRIENDLY and DOABLE.
+Each request lists numbered TASKS, one TARGET GRAMMAR and topic per sentence.
 
 HARD RULES — follow ALL of them:
 1. SHORT. Each sentence MUST be 6–12 words. No long sentences. No nested clauses.
@@ -190,8 +1098,8 @@ HARD RULES — follow ALL of them:
    - Might (present speculation) → "Возможно, он дома." / "Может быть, она устала."
    - Not quite as ... as ... → "Этот кофе не такой крепкий, как прошлый." (small difference)
    - Not nearly as ... as ... → "Мой старый телефон совсем не такой быстрый, как новый." (big difference)
-   - "The sooner the better" → "Чем раньше, тем лучше."
-7. Across the {n} sentences, no two may start with the same word. Mix subjects (я, мы, ты, он, она, они, impersonal).
+   - "The sooner the better" → "Чем раньше мы выйдем, тем лучше."
+7. Across the sentences of one reply, no two may start with the same word. Mix subjects (я, мы, ты, он, она, они, impersonal).
 
 SELF-CHECK before outputting each sentence:
 - Is it 6–12 words? If longer, SHORTEN it.
@@ -205,33 +1113,347 @@ OUTPUT FORMAT (follow exactly, nothing else):
 
 No explanations, no English, no quotation marks, no bold. Just numbered Russian sentences."""
 
-    try:
-        logger.info(f"Calling DeepSeek (batch of {n}) | Topics: {topics}")
-        raw = _call_deepseek(prompt, temperature=0.8, max_tokens=600)
-        logger.info(f"Raw batch output:\n{raw}")
-
-        sentences = []
-        for line in raw.split('\n'):
-            line = line.strip()
-            if not line:
-                continue
-            m = re.match(r'^\s*\d+[.)]\s*(.+)$', line)
-            if m:
-                s = m.group(1).strip()
-                for bad in ['"', '«', '»', '*', '_']:
-                    s = s.replace(bad, '')
-                sentences.append(s.strip())
 
-        if len(sentences) < n:
-            logger.warning(f"Got only {len(sentences)}/{n} sentences, falling back for missing ones")
-            while len(sentences) < n:
-                sentences.append(random.choice(FALLBACK_SENTENCES))
+def _numbered_tasks(structures: list, topics: list) -> str:
+    return "\n".join(
+        f"{i+1}. TARGET GRAMMAR (must be the main clause): {s}\n"
+        f"   Topic (weave in naturally): {topics[i]}"
+        for i, s in enumerate(structures)
+    )
+
+
+def _batch_prompt(structures: list, topics: list) -> str:
+    """The variable part of a generation request; the rules live in GENERATION_SYSTEM_PROMPT."""
+    return f"""Write {len(structures)} sentences.
+
+TASKS:
+{_numbered_tasks(structures, topics)}"""
+
+
+async def _generate_batch(structures: list, topics: list) -> list:
+    """One DeepSeek call for len(structures) sentences; may return fewer, raises on API errors."""
+    n = len(structures)
+    prompt = _batch_prompt(structures, topics)
+    logger.info(f"Calling DeepSeek (batch of {n}) | Topics: {topics}")
+    raw = await _call_deepseek(prompt, temperature=0.8, max_tokens=600, operation="generate",
+                               system=GENERATION_SYSTEM_PROMPT)
+    logger.info(f"Raw batch output:\n{raw}")
+    return _parse_numbered_sentences(raw)[:n]
+
+
+# --- Validation and targeted repair of generated sentences ---
+_GRAMMAR_MARKER_BY_STRUCTURE = {s: re.compile(m) for s, m in zip(GRAMMAR_STRUCTURES, GRAMMAR_MARKERS)}
+
+
+def _words(sentence: str) -> list:
+    return [w.strip(".,!?;:—–-()").lower() for w in sentence.split() if any(c.isalpha() for c in w)]
+
+
+def _sentence_problem(sentence: str, structure: str, used_first_words: set):
+    """Return why `sentence` breaks the prompt's rules for `structure`, or None if it is fine."""
+    words = _words(sentence)
+    if not 6 <= len(words) <= 12:
+        return "length"
+    if re.search(r"[A-Za-z]", sentence):
+        return "script"
+    marker = _GRAMMAR_MARKER_BY_STRUCTURE.get(structure)
+    if marker is not None and not marker.search(sentence.lower()):
+        return "grammar"
+    if words[0] in used_first_words:
+        return "first_word"
+    return None
+
+
+def _validate_batch(sentences: list, structures: list) -> dict:
+    """Map slot index → problem for every slot that is missing or breaks a rule.
+
+    Slots are checked in order, so of two sentences starting with the same
+    word the later one is the one sent for repair.
+    """
+    problems = {}
+    used_first_words = set()
+    for i, structure in enumerate(structures):
+        sentence = sentences[i] if i < len(sentences) else None
+        problem = "missing" if not sentence else _sentence_problem(sentence, structure, used_first_words)
+        if problem:
+            problems[i] = problem
+            GENERATION_REJECTS.inc(reason=problem)
+        else:
+            used_first_words.add(_words(sentence)[0])
+    return problems
+
 
-        return sentences[:n]
+_PROBLEM_HINTS = {
+    "missing": "",
+    "length": "The previous attempt had the wrong length. ",
+    "script": "The previous attempt contained Latin letters. ",
+    "grammar": "The previous attempt did not use the required Russian construction. ",
+    "first_word": "The previous attempt started with a word another sentence already uses. ",
+}
 
+
+def _repair_prompt(structure: str, topic: str, problem: str, taken_first_words: list) -> str:
+    """A one-task request that reuses GENERATION_SYSTEM_PROMPT, so repairs share its cached prefix."""
+    avoid = ", ".join(sorted(taken_first_words)) or "none"
+    return f"""Write 1 sentence. {_PROBLEM_HINTS.get(problem, "")}
+Do NOT start it with any of these words: {avoid}
+
+TASKS:
+{_numbered_tasks([structure], [topic])}"""
+
+
+async def _repair_sentence(structure: str, topic: str, problem: str, taken_first_words: list):
+    prompt = _repair_prompt(structure, topic, problem, taken_first_words)
+    try:
+        raw = await _call_deepseek(prompt, temperature=0.9, max_tokens=80, operation="repair",
+                                   system=GENERATION_SYSTEM_PROMPT)
+    except Exception as e:
+        logger.error(f"Sentence repair failed: {e}")
+        return None
+    lines = [line for line in raw.strip().split("\n") if line.strip()]
+    if not lines:
+        return None
+    # Usually "1. ...", as the system prompt asks; accept a bare sentence too
+    return (_parse_numbered_lines(lines[0]) or _parse_numbered_lines(f"1. {lines[0]}"))[0]
+
+
+async def repair_sentences(sentences: list, structures: list, topics: list,
+                           rounds: int = GENERATION_REPAIR_ROUNDS) -> list:
+    """Re-generate only the slots that fail validation, concurrently, for up to `rounds` rounds.
+
+    Returns a list aligned with `structures`; slots still failing after the
+    last round hold a fallback for their structure, reworded if its first word is taken.
+    """
+    sentences = list(sentences[:len(structures)]) + [None] * (len(structures) - len(sentences))
+    problems = _validate_batch(sentences, structures)
+    for round_no in range(rounds):
+        if not problems:
+            break
+        logger.info(f"Repair round {round_no + 1}: {problems}")
+        taken = [_words(s)[0] for i, s in enumerate(sentences) if i not in problems]
+        repaired = await asyncio.gather(*(
+            _repair_sentence(structures[i], topics[i], problem, taken) for i, problem in problems.items()
+        ))
+        for i, sentence in zip(problems, repaired):
+            if sentence:
+                sentences[i] = sentence
+        problems = _validate_batch(sentences, structures)
+
+    for i in problems:
+        logger.warning(f"Slot {i + 1} still invalid ({problems[i]}), using fallback")
+        GENERATION_FALLBACKS.inc()
+    return _fill_with_fallbacks(sentences, structures, list(problems))
+
+
+def _fallback_for(structure: str, taken_first_words=()) -> str:
+    """A hand-written sentence for `structure` whose first word is not taken, if one exists.
+
+    Each known structure has two fallbacks starting with different words;
+    unknown structures draw from all of them.
+    """
+    try:
+        i = GRAMMAR_STRUCTURES.index(structure)
+        candidates = [FALLBACK_SENTENCES[i], FALLBACK_ALTERNATIVES[i]]
+    except ValueError:
+        candidates = random.sample(FALLBACK_SENTENCES, len(FALLBACK_SENTENCES))
+    for sentence in candidates:
+        if _words(sentence)[0] not in taken_first_words:
+            return sentence
+    return candidates[0]
+
+
+def _fill_with_fallbacks(sentences: list, structures: list, slots: list) -> list:
+    """Put a fallback into each slot in `slots`, avoiding first words the other sentences use."""
+    taken = {_words(s)[0] for i, s in enumerate(sentences) if i not in slots and s}
+    for i in slots:
+        sentences[i] = _fallback_for(structures[i], taken)
+        taken.add(_words(sentences[i])[0])
+    return sentences
+
+
+async def generate_russian_sentences_batch(structures: list, chat_id=None) -> list:
+    """Generate N Russian sentences in a single call. EASY level for Elena (A2)."""
+    n = len(structures)
+    topics = get_unique_topics(n, chat_id)
+
+    try:
+        sentences = await _generate_batch(structures, topics)
     except Exception as e:
         logger.error(f"Batch generation error: {e}")
-        return [random.choice(FALLBACK_SENTENCES) for _ in range(n)]
+        return _fill_with_fallbacks([None] * n, structures, list(range(n)))
+
+    if len(sentences) < n:
+        logger.warning(f"Got only {len(sentences)}/{n} sentences, repairing the missing ones")
+    return await repair_sentences(sentences, structures, topics)
+
+
+async def stream_russian_sentences_batch(structures: list, chat_id=None):
+    """Like generate_russian_sentences_batch, but yields each sentence as soon as its line is complete.
+
+    Sentences that pass validation are yielded at once; failing or missing
+    slots are repaired after the stream ends and yielded last.
+    """
+    n = len(structures)
+    topics = get_unique_topics(n, chat_id)
+    prompt = _batch_prompt(structures, topics)
+    sentences = [None] * n
+    yielded = set()
+    used_first_words = set()
+    buffer = ""
+
+    def accept(sentence):
+        """Store the next slot's sentence; True if it is valid and can be shown now."""
+        i = sentences.index(None)
+        sentences[i] = sentence
+        problem = _sentence_problem(sentence, structures[i], used_first_words)
+        if problem:
+            GENERATION_REJECTS.inc(reason=problem)
+            return False
+        used_first_words.add(_words(sentence)[0])
+        yielded.add(i)
+        return True
+
+    try:
+        logger.info(f"Streaming DeepSeek (batch of {n}) | Topics: {topics}")
+        async for delta in _stream_deepseek(prompt, temperature=0.8, max_tokens=600, operation="generate_stream",
+                                            system=GENERATION_SYSTEM_PROMPT):
+            buffer += delta
+            *lines, buffer = buffer.split("\n")
+            for sentence in _parse_numbered_sentences("\n".join(lines)):
+                if None in sentences and accept(sentence):
+                    yield sentence
+        for sentence in _parse_numbered_sentences(buffer):
+            if None in sentences and accept(sentence):
+                yield sentence
+    except Exception as e:
+        logger.error(f"Streamed batch generation error: {e}")
+        missing = [i for i in range(n) if i not in yielded]
+        _fill_with_fallbacks(sentences, structures, missing)
+        for i in missing:
+            yield sentences[i]
+        return
+
+    if len(yielded) < n:
+        logger.warning(f"Streamed {len(yielded)}/{n} valid sentences, repairing the rest")
+        repaired = await repair_sentences(sentences, structures, topics)
+        for i in range(n):
+            if i not in yielded:
+                yield repaired[i]
+
+
+class SentencePool:
+    """Background-refilled queue of ready-made quiz batches.
+
+    `pop()` never waits for DeepSeek: it returns a stored batch (or None) and
+    starts a refill once the pool drops to `low_water`. Batches are generated
+    against global rotation history; for a given chat, `pop()` serves the one
+    whose grammar that chat has used least and skips any repeating one of its
+    recent topics, returning None (live generation) if every batch does.
+    Batches are validated and repaired before they are pooled. `path` is
+    rewritten whenever a batch is added or taken (and once more on shutdown);
+    batches loaded from it have their topics re-registered as recent, so
+    restarts don't repeat them.
+    """
+
+    def __init__(self, depth: int = SENTENCE_POOL_DEPTH, low_water: int = SENTENCE_POOL_LOW_WATER,
+                 path: str = SENTENCE_POOL_PATH, size: int = QUIZ_SIZE):
+        self.depth = depth
+        self.low_water = low_water
+        self.path = path
+        self.size = size
+        self._batches = deque()
+        self._refill_task = None
+
+    def __len__(self):
+        return len(self._batches)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                batches = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load sentence pool from {self.path}: {e}")
+            return
+        if not isinstance(batches, list):
+            logger.error(f"Ignoring sentence pool in {self.path}: not a list of batches")
+            return
+        valid = [batch for batch in batches if self._valid(batch)]
+        if len(valid) < len(batches):
+            logger.warning(f"Skipped {len(batches) - len(valid)} malformed batches in {self.path}")
+        for batch in valid[:self.depth]:
+            self._batches.append(batch)
+            remember_topics(batch.get("topics", []))
+        logger.info(f"Loaded {len(self._batches)} pooled sentence batches")
+
+    def _valid(self, batch) -> bool:
+        def strings(value):
+            return isinstance(value, list) and all(isinstance(s, str) for s in value)
+        return (isinstance(batch, dict) and strings(batch.get("sentences")) and len(batch["sentences"]) == self.size
+                and strings(batch.get("topics", [])) and strings(batch.get("structures", [])))
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self._batches), f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Could not save sentence pool to {self.path}: {e}")
+
+    def pop(self, chat_id=None):
+        batch = None
+        if self._batches and chat_id is None:
+            batch = self._batches.popleft()
+        elif self._batches:
+            scores = [rotation.score_batch(b.get("topics", []), b.get("structures", []), chat_id)
+                      for b in self._batches]
+            best = min(range(len(scores)), key=scores.__getitem__)
+            if scores[best][0] == 0:
+                batch = self._batches[best]
+                del self._batches[best]
+        if batch is not None:
+            self.save()
+        if len(self._batches) <= self.low_water:
+            self.ensure_refill()
+        return batch
+
+    def ensure_refill(self):
+        if self.depth > 0 and (self._refill_task is None or self._refill_task.done()):
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        while len(self._batches) < self.depth:
+            structures = pick_grammar_structures(self.size)
+            topics = get_unique_topics(self.size)
+            try:
+                sentences = await _generate_batch(structures, topics)
+            except Exception as e:
+                logger.error(f"Sentence pool refill failed: {e}")
+                return
+            sentences = await repair_sentences(sentences, structures, topics)
+            self._batches.append({"structures": structures, "topics": topics, "sentences": sentences})
+            self.save()
+            logger.info(f"Sentence pool refilled: {len(self._batches)}/{self.depth}")
+
+    async def start(self):
+        self.load()
+        self.ensure_refill()
+
+    async def stop(self):
+        if self._refill_task is not None and not self._refill_task.done():
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+        self.save()
+
+
+sentence_pool = SentencePool()
 
 
 # Fallback sentences — short, easy, target Elena's specific grammar list.
@@ -241,52 +1463,1069 @@ FALLBACK_SENTENCES = [
     "Если бы я позанималась, я бы сдала экзамен.",                  # 3rd cond
     "Жаль, что у меня нет больше времени.",                          # wish (present)
     "Жаль, что я не пошла вчера на вечеринку.",                      # wish (past)
-    "Наверное, она забыла про встречу.",                             # must have
-    "Возможно, он уже ушёл домой.",                                  # might have
+    "Наверное, она забыла про нашу встречу.",                        # must have
+    "Возможно, он уже ушёл домой с работы.",                         # might have
     "Должно быть, она устала после работы.",                         # must (present)
-    "Может быть, он дома сейчас.",                                   # might (present)
+    "Может быть, он сейчас дома с детьми.",                          # might (present)
     "Этот кофе не такой крепкий, как прошлый.",                      # not quite as
     "Мой старый телефон совсем не такой быстрый, как новый.",        # not nearly as
-    "Чем раньше, тем лучше.",                                        # the sooner the better
+    "Чем раньше мы купим билеты, тем лучше.",                        # the sooner the better
 ]
 
+# Same structures, reworded to start with a different word, for when the first fallback's is taken.
+FALLBACK_ALTERNATIVES = [
+    "Мы останемся дома, если завтра пойдёт дождь.",                 # 1st cond
+    "Я бы выучила испанский, если бы у меня было время.",           # 2nd cond
+    "Она бы сдала экзамен, если бы больше занималась.",             # 3rd cond
+    "Мне жаль, что у меня мало свободного времени.",                # wish (present)
+    "Очень жаль, что мы не поехали летом на море.",                 # wish (past)
+    "Она, наверное, забыла про нашу встречу.",                      # must have
+    "Он, возможно, уже ушёл домой с работы.",                       # might have
+    "Она, должно быть, очень устала после работы.",                 # must (present)
+    "Он, может быть, сейчас дома с детьми.",                        # might (present)
+    "Сегодня кофе не такой крепкий, как вчера.",                    # not quite as
+    "Новый телефон совсем не такой удобный, как старый.",           # not nearly as
+    "Мне кажется, чем раньше мы уйдём, тем лучше.",                 # the sooner the better
+]
 
-def translate_sentence(text: str, target_lang: str) -> str:
-    """Translate Russian sentence to target language using DeepSeek."""
-    lang_names = {
-        "es": "Spanish", "fr": "French", "de": "German",
-        "it": "Italian", "pt": "Portuguese", "ar": "Arabic", "he": "Hebrew",
-        "en": "English"
-    }
-    lang_name = lang_names.get(target_lang, target_lang.upper())
 
-    prompt = f"""Translate this Russian sentence to {lang_name}.
+class TranslationCache:
+    """LRU cache of translations keyed by (Russian sentence, target language).
+
+    Entries live in memory up to `max_size` and are mirrored to SQLite so they
+    survive restarts. With `ttl` > 0, entries older than `ttl` seconds are
+    treated as missing and their rows deleted, both on startup and when a
+    read finds one.
+    """
+
+    def __init__(self, path: str = "", max_size: int = 5000, ttl: float = 0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._db = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS translations ("
+                    "sentence TEXT NOT NULL, lang TEXT NOT NULL, translation TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, PRIMARY KEY (sentence, lang))"
+                )
+                if ttl > 0:
+                    self._db.execute("DELETE FROM translations WHERE created_at < ?", (time.time() - ttl,))
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Translation cache disabled on disk ({path}): {e}")
+                self._db = None
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl > 0 and time.time() - created_at > self.ttl
+
+    def _remember(self, key: tuple, translation: str, created_at: float):
+        self._entries[key] = (translation, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, sentence: str, lang: str):
+        key = (sentence, lang)
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            row = self._db.execute(
+                "SELECT translation, created_at FROM translations WHERE sentence = ? AND lang = ?",
+                key
+            ).fetchone()
+            if row:
+                entry = (row[0], row[1])
+                self._remember(key, *entry)
+        if entry is None or self._expired(entry[1]):
+            if entry is not None:
+                self._entries.pop(key, None)
+                self._delete(key)
+            self.misses += 1
+            TRANSLATION_CACHE_MISSES.inc()
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        TRANSLATION_CACHE_HITS.inc()
+        return entry[0]
+
+    def _delete(self, key: tuple):
+        if self._db is None:
+            return
+        try:
+            self._db.execute("DELETE FROM translations WHERE sentence = ? AND lang = ?", key)
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Translation cache delete failed: {e}")
+
+    def put(self, sentence: str, lang: str, translation: str):
+        created_at = time.time()
+        self._remember((sentence, lang), translation, created_at)
+        if self._db is not None:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO translations (sentence, lang, translation, created_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (sentence, lang, translation, created_at)
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Translation cache write failed: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._entries),
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+translation_cache = TranslationCache(TRANSLATION_CACHE_PATH, TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL)
+CallbackGauge("translation_cache_size", "Translations held in memory", lambda: len(translation_cache._entries))
+
+
+LANG_NAMES = {
+    "es": "Spanish", "fr": "French", "de": "German",
+    "it": "Italian", "pt": "Portuguese", "ar": "Arabic", "he": "Hebrew",
+    "en": "English"
+}
+
+
+# Shared system message for single and batched translation calls;
+# the sentences and target languages go in the user message.
+TRANSLATION_SYSTEM_PROMPT = """You translate short Russian sentences written for an adult English learner (A2 level).
+The translations are sent to the learner's practice partners, so they must be easy to read.
 Use simple, everyday A2-level vocabulary.
-Keep it short and natural.
+Keep each translation short and natural, and keep the meaning and grammar of the original:
+conditionals stay conditionals, wishes stay wishes, guesses stay guesses, comparisons stay comparisons.
+Never add explanations, transliterations, alternatives or comments.
+Each request gives the Russian sentence(s), the target language(s) and the required output format."""
+
+
+def _clean_translation(translation: str) -> str:
+    for bad in ['"', '«', '»', '\n']:
+        translation = translation.replace(bad, '')
+    return translation.strip()
+
+
+def failed_translation(lang: str) -> str:
+    """Placeholder returned (never cached) when translating into `lang` fails."""
+    return f"[Translation to {LANG_NAMES.get(lang, lang.upper())} failed]"
+
+
+class TranslationBatcher:
+    """Micro-batch distinct (sentence, language) translations into one DeepSeek completion.
+
+    Requests wait up to `wait` seconds for company, or until `max_size` are
+    queued, then go out together. A batch of one uses the plain single-language
+    prompt; languages missing from a batched reply are retried one by one.
+    Failures resolve to "[Translation to X failed]" and are not cached.
+    Concurrent callers for the same pair share one future and are counted:
+    pairs whose callers were all cancelled are dropped before the batch is
+    sent, and a running batch is cancelled once none of its pairs is wanted.
+    """
+
+    def __init__(self, max_size: int = TRANSLATION_BATCH_SIZE, wait: float = TRANSLATION_BATCH_WAIT):
+        self.max_size = max(1, max_size)
+        self.wait = wait
+        self._pending = {}
+        self._running = {}  # key -> (future, batch task, batch)
+        self._callers = {}
+        self._flush_handle = None
+
+    async def translate(self, text: str, lang: str) -> str:
+        key = (text, lang)
+        future = self._pending.get(key) or self._running.get(key, (None,))[0]
+        if future is None or future.cancelled():
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            if len(self._pending) >= self.max_size or self.wait <= 0:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.wait, self._flush)
+        else:
+            COALESCED_REQUESTS.inc(flight="translation")
+        self._callers[key] = self._callers.get(key, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self._callers[key] -= 1
+            if not self._callers[key]:
+                del self._callers[key]
+                if not future.done():
+                    self._abandon(key, future)
+
+    def _abandon(self, key, future):
+        """Every caller of `key` is gone: drop it from the queue, or stop its batch if nothing else needs it."""
+        future.cancel()
+        if self._pending.get(key) is future:
+            del self._pending[key]
+            if not self._pending and self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            return
+        _, task, batch = self._running.get(key, (None, None, {}))
+        if task is not None and all(f.done() for f in batch.values()):
+            task.cancel()
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            for key, future in batch.items():
+                self._running[key] = (future, task, batch)
+            task.add_done_callback(lambda _: self._forget(batch))
+
+    def _forget(self, batch: dict):
+        for key in batch:
+            if self._running.get(key, (None, None, None))[2] is batch:
+                del self._running[key]
+
+    async def _run(self, batch: dict):
+        TRANSLATION_BATCH_ITEMS.observe(len(batch))
+        try:
+            results = await _translate_items(list(batch), lambda key: not batch[key].done())
+        except Exception as e:
+            logger.error(f"Translation batch error: {e}")
+            results = {}
+        for (text, lang), future in batch.items():
+            if not future.done():
+                future.set_result(results.get((text, lang)) or failed_translation(lang))
+
+
+async def translate_sentence(text: str, target_lang: str) -> str:
+    """Translate Russian sentence to target language using DeepSeek."""
+    with TRANSLATION_SECONDS.time(mode="single"):
+        return await _translate_sentence(text, target_lang)
+
+
+async def _translate_sentence(text: str, target_lang: str) -> str:
+    cached = translation_cache.get(text, target_lang)
+    if cached is not None:
+        logger.info(f"Translation cache hit ({LANG_NAMES.get(target_lang, target_lang.upper())}): {cached}")
+        return cached
+    return await translation_batcher.translate(text, target_lang)
+
+
+async def _translate_one(text: str, target_lang: str) -> str:
+    """One single-language DeepSeek call; caches and returns the translation, raises on API errors."""
+    lang_name = LANG_NAMES.get(target_lang, target_lang.upper())
+    prompt = f"""Translate into {lang_name}.
 Output ONLY the translated sentence, nothing else — no quotes, no notes.
 
 Russian: {text}"""
 
-    try:
-        translation = _call_deepseek(prompt, temperature=0.3, max_tokens=150)
-        for bad in ['"', '«', '»', '\n']:
-            translation = translation.replace(bad, '')
-        logger.info(f"Translated to {lang_name}: {translation}")
-        return translation.strip()
+    translation = _clean_translation(
+        await _call_deepseek(prompt, temperature=0.3, max_tokens=150, operation="translate",
+                             system=TRANSLATION_SYSTEM_PROMPT)
+    )
+    logger.info(f"Translated to {lang_name}: {translation}")
+    if translation:
+        translation_cache.put(text, target_lang, translation)
+    return translation
+
 
+async def _translate_one_or_fail(text: str, target_lang: str) -> str:
+    try:
+        return await _translate_one(text, target_lang)
     except Exception as e:
         logger.error(f"Translation error: {e}")
-        return f"[Translation to {lang_name} failed]"
+        return failed_translation(target_lang)
+
+
+def _json_object(raw: str) -> dict:
+    """The outermost JSON object in a model reply, tolerating code fences and chatter."""
+    start, end = raw.find("{"), raw.rfind("}")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        data = json.loads(raw[start:end + 1])
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _translations_from(data: dict, langs: list) -> dict:
+    """Map {language key or name: text} onto {lang_code: cleaned translation} for `langs`."""
+    by_alias = {}
+    for code in langs:
+        by_alias[code.lower()] = code
+        by_alias[LANG_NAMES.get(code, code).lower()] = code
+
+    result = {}
+    for key, value in data.items():
+        code = by_alias.get(str(key).strip().lower())
+        if code and isinstance(value, str) and _clean_translation(value):
+            result[code] = _clean_translation(value)
+    return result
+
+
+def _batch_translation_prompt(groups: list) -> str:
+    """`groups` is [(sentence, [lang codes])]; sentences are numbered from 1."""
+    blocks = "\n".join(
+        f"{i}. Russian: {text}\n"
+        f"   Languages (JSON key: language): "
+        + ", ".join(f'"{code}": {LANG_NAMES.get(code, code.upper())}' for code in langs)
+        for i, (text, langs) in enumerate(groups, 1)
+    )
+    return f"""Translate each numbered Russian sentence into the languages listed under it.
+
+{blocks}
+
+Output ONLY a JSON object mapping each sentence number to an object of its translations,
+like {{"1": {{"en": "..."}}}} — nothing else, no notes, no code fences."""
+
+
+async def _translate_items(items: list, wanted=lambda item: True) -> dict:
+    """Translate [(sentence, lang)] with as few DeepSeek calls as possible; returns {(sentence, lang): text}.
+
+    Items for which `wanted(item)` is false by the time the batched reply is
+    in are not retried one by one.
+    """
+    if len(items) == 1:
+        text, lang = items[0]
+        return {items[0]: await _translate_one_or_fail(text, lang)}
+
+    groups = {}
+    for text, lang in items:
+        groups.setdefault(text, []).append(lang)
+    groups = list(groups.items())
+
+    results = {}
+    try:
+        raw = await _call_deepseek(_batch_translation_prompt(groups), temperature=0.3,
+                                   max_tokens=150 * len(items), operation="translate_batch",
+                                   system=TRANSLATION_SYSTEM_PROMPT)
+        data = _json_object(raw)
+        for i, (text, langs) in enumerate(groups, 1):
+            inner = data.get(str(i))
+            for lang, translation in _translations_from(inner if isinstance(inner, dict) else {}, langs).items():
+                logger.info(f"Translated to {LANG_NAMES.get(lang, lang.upper())}: {translation}")
+                translation_cache.put(text, lang, translation)
+                results[(text, lang)] = translation
+    except Exception as e:
+        logger.error(f"Batched translation error: {e}")
+
+    leftover = [item for item in items if item not in results and wanted(item)]
+    if leftover:
+        logger.warning(f"Batched reply missing {len(leftover)}/{len(items)} translations, translating them one by one")
+        singles = await asyncio.gather(*(_translate_one_or_fail(text, lang) for text, lang in leftover))
+        results.update(zip(leftover, singles))
+    return results
+
+
+translation_batcher = TranslationBatcher()
+
+
+async def translate_sentence_multi(text: str, target_langs: list) -> dict:
+    """Translate one Russian sentence into several languages.
+
+    Cached languages are served from `translation_cache`; the rest go through
+    `translation_batcher` together, so they share one DeepSeek call (with any
+    other translations requested at the same moment).
+    """
+    with TRANSLATION_SECONDS.time(mode="multi"):
+        langs = list(dict.fromkeys(l for l in target_langs if l != "ru"))
+        translations = await asyncio.gather(*(_translate_sentence(text, lang) for lang in langs))
+        return dict(zip(langs, translations))
+
+
+# --- Telegram fan-out ---
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, at most `capacity` banked."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for `seconds` (used after a flood-wait)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    def wait_time(self) -> float:
+        """Seconds until `acquire` could take a token without sleeping (0 if it can now)."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SendScheduler:
+    """Sends Telegram messages within Bot API limits.
+
+    Every send takes a token from the global bucket and from the chat's own
+    bucket; group chats (negative ids) also draw from a per-group bucket
+    sized for Telegram's messages-per-minute limit. `RetryAfter` pauses that
+    chat before retrying.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST, group_rate_per_min: float = TELEGRAM_GROUP_RATE_PER_MIN,
+                 max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate_per_min = group_rate_per_min
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._group_buckets = {}
+
+    def _buckets_for(self, chat_id: int) -> list:
+        chat_bucket = self._chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            chat_bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        buckets = [chat_bucket]
+        if chat_id < 0:
+            group_bucket = self._group_buckets.get(chat_id)
+            if group_bucket is None:
+                group_bucket = self._group_buckets[chat_id] = TokenBucket(
+                    self.group_rate_per_min / 60, self.chat_burst
+                )
+            buckets.append(group_bucket)
+        return buckets
+
+    def ready_in(self, chat_id: int) -> float:
+        """Seconds until the chat's own limits (not the global one) allow another send."""
+        return max(bucket.wait_time() for bucket in self._buckets_for(chat_id))
+
+    async def send_message(self, bot, chat_id: int, text: str, **kwargs):
+        buckets = self._buckets_for(chat_id)
+        for attempt in range(self.max_retries + 1):
+            for bucket in buckets:
+                await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                with TELEGRAM_SEND_SECONDS.time():
+                    return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except Exception as e:
+                TELEGRAM_SEND_ERRORS.inc(error=type(e).__name__)
+                if not isinstance(e, RetryAfter) or attempt == self.max_retries:
+                    raise
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                logger.warning(f"Flood wait for chat {chat_id}: retrying in {delay}s")
+                for bucket in buckets:
+                    bucket.pause(delay)
+
+
+send_scheduler = SendScheduler()
+
+# --- State store ---
+class MemoryStateBackend:
+    """Quiz sessions and topic history kept in process memory.
+
+    Quiz expiry is indexed by a heap of (expires_at, chat_id); stale heap
+    entries (quiz replaced or finished) are skipped when popped.
+    """
+
+    def __init__(self):
+        self._quizzes = {}
+        self._expiry = []
+        self._topics = {}
+
+    def get_quiz(self, chat_id: int):
+        # A copy, like the SQLite backend: callers edit it and write it back with put_quiz
+        session = self._quizzes.get(chat_id)
+        return copy.deepcopy(session) if session is not None else None
+
+    def put_quiz(self, chat_id: int, session: dict):
+        previous = self._quizzes.get(chat_id)
+        self._quizzes[chat_id] = copy.deepcopy(session)
+        if previous is None or previous['expires_at'] != session['expires_at']:
+            heapq.heappush(self._expiry, (session['expires_at'], chat_id))
+
+    def delete_quiz(self, chat_id: int):
+        return self._quizzes.pop(chat_id, None)
+
+    def next_expiry(self):
+        while self._expiry:
+            expires_at, chat_id = self._expiry[0]
+            session = self._quizzes.get(chat_id)
+            if session is not None and session['expires_at'] == expires_at:
+                return expires_at
+            heapq.heappop(self._expiry)
+        return None
+
+    def pop_expired(self, now: float) -> list:
+        expired = []
+        while (expires_at := self.next_expiry()) is not None and expires_at <= now:
+            _, chat_id = heapq.heappop(self._expiry)
+            del self._quizzes[chat_id]
+            expired.append(chat_id)
+        return expired
+
+    def get_topic_history(self, key: str) -> list:
+        return list(self._topics.get(key, []))
+
+    def set_topic_history(self, key: str, topics: list):
+        self._topics[key] = list(topics)
+
+    def close(self):
+        pass
+
+
+class SqliteStateBackend:
+    """Quiz sessions and topic history in SQLite, so a restart keeps open keyboards.
+
+    Sessions are stored as JSON with an indexed `expires_at` column that drives
+    expiry.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS quizzes ("
+            "chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS quizzes_expires_at ON quizzes (expires_at);"
+            "CREATE TABLE IF NOT EXISTS topic_history (key TEXT PRIMARY KEY, topics TEXT NOT NULL);"
+        )
+        self._db.commit()
+
+    def get_quiz(self, chat_id: int):
+        row = self._db.execute("SELECT data FROM quizzes WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_quiz(self, chat_id: int, session: dict):
+        self._db.execute(
+            "INSERT OR REPLACE INTO quizzes (chat_id, data, expires_at) VALUES (?, ?, ?)",
+            (chat_id, json.dumps(session, ensure_ascii=False), session['expires_at'])
+        )
+        self._db.commit()
+
+    def delete_quiz(self, chat_id: int):
+        session = self.get_quiz(chat_id)
+        self._db.execute("DELETE FROM quizzes WHERE chat_id = ?", (chat_id,))
+        self._db.commit()
+        return session
+
+    def next_expiry(self):
+        row = self._db.execute("SELECT MIN(expires_at) FROM quizzes").fetchone()
+        return row[0]
+
+    def pop_expired(self, now: float) -> list:
+        rows = self._db.execute("SELECT chat_id FROM quizzes WHERE expires_at <= ?", (now,)).fetchall()
+        self._db.execute("DELETE FROM quizzes WHERE expires_at <= ?", (now,))
+        self._db.commit()
+        return [row[0] for row in rows]
+
+    def get_topic_history(self, key: str) -> list:
+        row = self._db.execute("SELECT topics FROM topic_history WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def set_topic_history(self, key: str, topics: list):
+        self._db.execute(
+            "INSERT OR REPLACE INTO topic_history (key, topics) VALUES (?, ?)",
+            (key, json.dumps(list(topics), ensure_ascii=False))
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def create_state_backend(kind: str = STATE_BACKEND, path: str = STATE_DB_PATH):
+    if kind == "sqlite" and path:
+        try:
+            return SqliteStateBackend(path)
+        except sqlite3.Error as e:
+            logger.error(f"Could not open state database {path}, using memory: {e}")
+    elif kind != "memory":
+        logger.warning(f"Unknown STATE_BACKEND {kind!r}, using memory")
+    return MemoryStateBackend()
+
+
+state_store = create_state_backend()
+
+
+# --- Delivery outbox ---
+OUTBOX_DELIVERIES = Counter("outbox_deliveries_total", "Finished outbox deliveries", ("status",))
+
+
+class Outbox:
+    """Durable queue of sentence deliveries, drained by a pool of async workers.
+
+    A click enqueues one row per (chat, language) under an idempotency key
+    (quiz message, sentence, chat, language), so repeating the same click
+    never queues a delivery twice. Workers translate and send the oldest
+    due row of any chat that has nothing in flight, which keeps each chat's
+    messages in order while different chats are served in parallel.
+    Transient errors, failed translations included, are retried with backoff;
+    Forbidden/BadRequest are final.
+    Rows left `sending` by a crash return to `pending` on start, so delivery
+    is at-least-once. Once every row of a click is finished the teacher
+    gets one confirmation. Finished rows older than `retention` are purged
+    on start and then every `_PURGE_INTERVAL` seconds by an idle worker.
+    """
+
+    _PURGE_INTERVAL = 600.0
+
+    def __init__(self, path: str = OUTBOX_PATH, workers: int = OUTBOX_WORKERS,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS, retention: float = OUTBOX_RETENTION):
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, batch TEXT NOT NULL,"
+            "chat_id INTEGER NOT NULL, lang TEXT NOT NULL, sentence TEXT NOT NULL,"
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,"
+            "not_before REAL NOT NULL DEFAULT 0, error TEXT, finished_at REAL);"
+            "CREATE INDEX IF NOT EXISTS outbox_status_chat ON outbox (status, chat_id, id);"
+            "CREATE INDEX IF NOT EXISTS outbox_batch ON outbox (batch);"
+            "CREATE TABLE IF NOT EXISTS outbox_batches ("
+            "batch TEXT PRIMARY KEY, notify_chat INTEGER NOT NULL, sentence TEXT NOT NULL,"
+            "confirmed INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL);"
+        )
+        self._db.commit()
+        self._bot = None
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._active = 0
+        self._purged_at = 0.0
+
+    def enqueue(self, batch: str, notify_chat: int, sentence: str, deliveries: list) -> int:
+        """Queue `sentence` for each (chat_id, langs) pair; returns how many rows were new."""
+        added = 0
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO outbox_batches (batch, notify_chat, sentence, created_at) VALUES (?, ?, ?, ?)",
+                (batch, notify_chat, sentence, time.time())
+            )
+            for chat_id, langs in deliveries:
+                for lang in langs:
+                    added += self._db.execute(
+                        "INSERT OR IGNORE INTO outbox (key, batch, chat_id, lang, sentence) VALUES (?, ?, ?, ?, ?)",
+                        (f"{batch}:{chat_id}:{lang}", batch, chat_id, lang, sentence)
+                    ).rowcount
+        self._wakeup.set()
+        return added
+
+    def pending_count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+
+    @property
+    def idle(self) -> bool:
+        return self._active == 0 and self.pending_count() == 0
+
+    def _claim(self):
+        # The oldest unfinished row of a chat is the only one that may go out,
+        # and only when it is due and not already being sent. Chats whose rate
+        # limits have no token yet are pushed back instead of parking a worker
+        # in TokenBucket.acquire while other chats could be served.
+        now = time.time()
+        rows = self._db.execute(
+            "SELECT id, batch, chat_id, lang, sentence, attempts FROM outbox AS o "
+            "WHERE status = 'pending' AND not_before <= ? AND id = ("
+            "SELECT MIN(id) FROM outbox WHERE chat_id = o.chat_id AND status IN ('pending', 'sending')) "
+            "ORDER BY id",
+            (now,)
+        ).fetchall()
+        claimed = None
+        for row in rows:
+            wait = send_scheduler.ready_in(row[2])
+            if wait > 0:
+                self._db.execute("UPDATE outbox SET not_before = ? WHERE id = ?", (now + wait, row[0]))
+                continue
+            self._db.execute("UPDATE outbox SET status = 'sending' WHERE id = ?", (row[0],))
+            claimed = row
+            break
+        self._db.commit()
+        return claimed
+
+    def _next_due_in(self) -> float:
+        row = self._db.execute("SELECT MIN(not_before) FROM outbox WHERE status = 'pending'").fetchone()
+        return 5.0 if row[0] is None else min(5.0, max(0.05, row[0] - time.time()))
+
+    def _finish(self, row_id: int, status: str, attempts: int, error: str = None, retry_in: float = 0):
+        if status == "pending":
+            self._db.execute(
+                "UPDATE outbox SET status = 'pending', attempts = ?, error = ?, not_before = ? WHERE id = ?",
+                (attempts, error, time.time() + retry_in, row_id)
+            )
+        else:
+            OUTBOX_DELIVERIES.inc(status=status)
+            self._db.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, attempts, error, time.time(), row_id)
+            )
+        self._db.commit()
+
+    async def _deliver(self, row):
+        row_id, batch, chat_id, lang, sentence, attempts = row
+        attempts += 1
+        try:
+            text = sentence if lang == "ru" else await translate_sentence(sentence, lang)
+            if lang != "ru" and text == failed_translation(lang):
+                # Retry later rather than deliver the placeholder
+                raise DeepSeekError(f"translation to {lang} failed")
+            await send_scheduler.send_message(self._bot, chat_id, text)
+        except (Forbidden, BadRequest) as e:
+            logger.error(f"Delivery to {chat_id} ({lang}) failed for good: {e}")
+            self._finish(row_id, "failed", attempts, str(e))
+        except (Exception, asyncio.CancelledError) as e:
+            # A cancellation aimed at someone else (e.g. a shared translation) is just a transient failure
+            if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                raise
+            error = str(e) or type(e).__name__
+            if attempts >= self.max_attempts:
+                logger.error(f"Delivery to {chat_id} ({lang}) failed after {attempts} attempts: {error}")
+                self._finish(row_id, "failed", attempts, error)
+            else:
+                retry_in = min(60.0, 2 ** attempts)
+                logger.warning(f"Delivery to {chat_id} ({lang}) failed ({error}), retrying in {retry_in:.0f}s")
+                self._finish(row_id, "pending", attempts, error, retry_in)
+                return
+        else:
+            logger.info(f"Delivered to {chat_id} ({lang}): {text}")
+            self._finish(row_id, "sent", attempts)
+        await self._confirm_if_done(batch)
+
+    async def _confirm_if_done(self, batch: str):
+        unfinished = self._db.execute(
+            "SELECT COUNT(*) FROM outbox WHERE batch = ? AND status IN ('pending', 'sending')", (batch,)
+        ).fetchone()[0]
+        info = self._db.execute(
+            "SELECT notify_chat, sentence FROM outbox_batches WHERE batch = ? AND confirmed = 0", (batch,)
+        ).fetchone()
+        if unfinished or info is None:
+            return
+        # Marked before sending so two workers finishing together confirm once
+        self._db.execute("UPDATE outbox_batches SET confirmed = 1 WHERE batch = ?", (batch,))
+        self._db.commit()
+        notify_chat, sentence = info
+        chats = self._db.execute(
+            "SELECT chat_id, MAX(status = 'failed') FROM outbox WHERE batch = ? GROUP BY chat_id", (batch,)
+        ).fetchall()
+        names = {chat_id: name for chat_id, name, _ in TARGET_CHATS}
+        failed = [names.get(chat_id, str(chat_id)) for chat_id, any_failed in chats if any_failed]
+        try:
+            await report_delivery(self._bot, batch, notify_chat, sentence, len(chats) - len(failed), failed)
+        except Exception as e:
+            logger.error(f"Could not report delivery of {batch} to {notify_chat}: {e}")
+
+    def _purge(self):
+        """Drop rows and clicks finished more than `retention` seconds ago."""
+        cutoff = time.time() - self.retention
+        with self._db:
+            self._db.execute("DELETE FROM outbox WHERE finished_at IS NOT NULL AND finished_at < ?", (cutoff,))
+            self._db.execute(
+                "DELETE FROM outbox_batches WHERE created_at < ? AND batch NOT IN (SELECT batch FROM outbox)",
+                (cutoff,)
+            )
+        self._purged_at = time.time()
+
+    async def _worker(self):
+        while True:
+            row = self._claim()
+            if row is None:
+                if time.time() - self._purged_at > self._PURGE_INTERVAL:
+                    self._purge()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._next_due_in())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._active += 1
+            try:
+                await self._deliver(row)
+            except (Exception, asyncio.CancelledError) as e:
+                if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                    raise
+                logger.error(f"Outbox worker error on row {row[0]}: {e!r}")
+                self._db.execute("UPDATE outbox SET status = 'pending' WHERE id = ? AND status = 'sending'", (row[0],))
+                self._db.commit()
+            finally:
+                self._active -= 1
+            # The chat is free again; its next row may now go to any worker
+            self._wakeup.set()
+
+    async def start(self, bot):
+        self._bot = bot
+        with self._db:
+            resumed = self._db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'").rowcount
+        self._purge()
+        pending = self.pending_count()
+        if pending:
+            logger.info(f"Resuming {pending} queued deliveries ({resumed} were interrupted mid-send)")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        for (batch,) in self._db.execute("SELECT batch FROM outbox_batches WHERE confirmed = 0").fetchall():
+            await self._confirm_if_done(batch)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Sends cut short by the cancellation are retried on the next start
+        self._db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def create_outbox(path: str = OUTBOX_PATH) -> Outbox:
+    try:
+        return Outbox(path)
+    except sqlite3.Error as e:
+        logger.error(f"Could not open outbox database {path}, using memory: {e}")
+        return Outbox("")
+
+
+outbox = create_outbox()
+CallbackGauge("outbox_pending", "Deliveries queued or being sent", outbox.pending_count)
+
+
+# --- Speculative translation ---
+# As soon as a quiz keyboard is shown, every sentence is translated in the
+# background; outbox workers then find the translation cached or join the
+# running request through translation_batcher.
+speculative_semaphore = asyncio.Semaphore(SPECULATIVE_CONCURRENCY)
+
+
+async def _speculative_translate(sentence: str, langs: list) -> dict:
+    async with speculative_semaphore:
+        return await translate_sentence_multi(sentence, langs)
+
+
+def start_speculative_translation(sentence: str) -> asyncio.Task:
+    langs = [l for _, _, chat_langs in TARGET_CHATS for l in chat_langs]
+    return asyncio.create_task(_speculative_translate(sentence, langs))
 
 
-active_quizzes = {}
+def start_speculative_translations(sentences: list) -> list:
+    return [start_speculative_translation(s) for s in sentences]
 
 
-async def cleanup_quiz(chat_id: int, delay: int = 30):
-    await asyncio.sleep(delay)
-    if chat_id in active_quizzes:
-        del active_quizzes[chat_id]
-        logger.info(f"Quiz expired for chat {chat_id}")
+# Tasks can't be persisted, so they live here rather than in the quiz session.
+quiz_translation_tasks = {}
+
+
+def cancel_speculative_translations(chat_id: int):
+    for task in quiz_translation_tasks.pop(chat_id, []):
+        if not task.done():
+            task.cancel()
+
+
+# One timer task expires every quiz: it sleeps until the earliest
+# `expires_at` in the state store and is woken early when a quiz is added.
+quiz_expiry_wakeup = asyncio.Event()
+
+
+def cleanup_quiz(chat_id: int):
+    """Forget a quiz and stop its background translations."""
+    state_store.delete_quiz(chat_id)
+    cancel_speculative_translations(chat_id)
+
+
+async def run_quiz_expiry():
+    while True:
+        for chat_id in state_store.pop_expired(time.time()):
+            cancel_speculative_translations(chat_id)
+            logger.info(f"Quiz expired for chat {chat_id}")
+        next_expiry = state_store.next_expiry()
+        timeout = None if next_expiry is None else max(0.0, next_expiry - time.time())
+        quiz_expiry_wakeup.clear()
+        try:
+            await asyncio.wait_for(quiz_expiry_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _quiz_header(title: str = None) -> str:
+    title = title or f"Выбери предложения для отправки ({len(TARGET_CHATS)} чатов):"
+    return (
+        f"🎯 **{title}**\n\n"
+        "• Нажми на предложение чтобы отправить его\n"
+        f"• Кнопки активны {QUIZ_TTL} секунд\n"
+        "• Нажми '✅ Готово' когда закончишь"
+    )
+
+
+def _quiz_keyboard(sentences: list) -> InlineKeyboardMarkup:
+    buttons = []
+    for i, sent in enumerate(sentences):
+        buttons.append([InlineKeyboardButton(f"📝 {sent}", callback_data=f"send_{i}")])
+    buttons.append([InlineKeyboardButton("✅ Готово", callback_data="finish")])
+    return InlineKeyboardMarkup(buttons)
+
+
+def _quiz_status(quiz_data: dict) -> tuple:
+    """Header text and keyboard for an open quiz, with the sent counter once something was sent."""
+    sentences = quiz_data['sentences']
+    title = f"Отправлено: {quiz_data['sent_count']}/{len(sentences)}" if quiz_data['sent_count'] else None
+    return _quiz_header(title), _quiz_keyboard(sentences)
+
+
+def quiz_batch_key(chat_id: int, message_id: int, idx: int) -> str:
+    """Outbox batch (and idempotency key prefix) for sentence `idx` of a quiz message."""
+    return f"{chat_id}:{message_id}:{idx}"
+
+
+STATUS_UPDATES = Counter("status_updates_total", "Quiz status message updates by outcome", ("outcome",))
+
+
+class _StatusMessage:
+    __slots__ = ("text", "markup", "notes", "shown", "last_edit", "version", "task")
+
+    def __init__(self):
+        self.text = None
+        self.markup = None
+        self.notes = deque(maxlen=STATUS_MAX_NOTES)
+        self.shown = None
+        self.last_edit = float("-inf")
+        self.version = 0
+        self.task = None
+
+
+class StatusUpdater:
+    """Coalesced, throttled edits of quiz status messages.
+
+    `set_status` and `add_note` only record what the message should show;
+    one task per message applies the latest state with a single
+    edit_message_text, at most once per `interval` seconds. Updates that
+    arrive in between are merged into the next edit, and an edit that would
+    not change the text or keyboard is skipped.
+    """
+
+    def __init__(self, interval: float = STATUS_EDIT_INTERVAL, max_messages: int = 1000):
+        self.interval = interval
+        self.max_messages = max_messages
+        self._messages = OrderedDict()
+
+    def _state(self, key):
+        state = self._messages.get(key)
+        if state is None:
+            state = self._messages[key] = _StatusMessage()
+            for old_key in list(self._messages)[:max(0, len(self._messages) - self.max_messages)]:
+                if self._messages[old_key].task is None:
+                    del self._messages[old_key]
+        self._messages.move_to_end(key)
+        return state
+
+    def track(self, chat_id: int, message_id: int, text: str, reply_markup=None):
+        """Record a message just sent with this text and keyboard, so no edit is needed yet."""
+        state = self._state((chat_id, message_id))
+        state.text = text
+        state.markup = reply_markup
+        state.shown = self._render(state)
+
+    def set_status(self, bot, chat_id: int, message_id: int, text: str, reply_markup=None):
+        state = self._state((chat_id, message_id))
+        state.text = text
+        state.markup = reply_markup
+        self._schedule(bot, (chat_id, message_id), state)
+
+    def add_note(self, bot, chat_id: int, message_id: int, note: str) -> bool:
+        """Append a line under the message's status; False if the message's status is unknown here."""
+        state = self._messages.get((chat_id, message_id))
+        if state is None or state.text is None:
+            return False
+        state.notes.append(note)
+        self._schedule(bot, (chat_id, message_id), state)
+        return True
+
+    def _schedule(self, bot, key, state: _StatusMessage):
+        state.version += 1
+        if state.task is None:
+            state.task = asyncio.create_task(self._run(bot, key, state))
+        else:
+            STATUS_UPDATES.inc(outcome="coalesced")
+
+    def _render(self, state: _StatusMessage) -> tuple:
+        text = state.text if not state.notes else state.text + "\n\n" + "\n".join(state.notes)
+        return text, state.markup.to_json() if state.markup is not None else None
+
+    async def _run(self, bot, key, state: _StatusMessage):
+        chat_id, message_id = key
+        try:
+            while True:
+                wait = state.last_edit + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                version = state.version
+                rendered = self._render(state)
+                if rendered == state.shown:
+                    STATUS_UPDATES.inc(outcome="unchanged")
+                else:
+                    state.last_edit = time.monotonic()
+                    try:
+                        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=rendered[0],
+                                                    reply_markup=state.markup)
+                        state.shown = rendered
+                        STATUS_UPDATES.inc(outcome="edit")
+                    except RetryAfter as e:
+                        delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                        logger.warning(f"Flood wait editing status in chat {chat_id}: retrying in {delay}s")
+                        state.last_edit = time.monotonic() + delay - self.interval
+                        continue
+                    except BadRequest as e:
+                        if "not modified" in str(e).lower():
+                            state.shown = rendered
+                        else:
+                            STATUS_UPDATES.inc(outcome="error")
+                            logger.warning(f"Could not update status message in chat {chat_id}: {e}")
+                    except Exception as e:
+                        STATUS_UPDATES.inc(outcome="error")
+                        logger.error(f"Status message edit failed in chat {chat_id}: {e}")
+                if state.version == version:
+                    break
+        finally:
+            state.task = None
+
+
+status_updater = StatusUpdater()
+
+
+async def report_delivery(bot, batch: str, notify_chat: int, sentence: str, delivered: int, failed: list):
+    """Tell the teacher a clicked sentence has gone out: a line in the quiz message, or a message."""
+    note = f"✅ {sentence} → {delivered} чатов"
+    if failed:
+        note += f" (не удалось: {', '.join(failed)})"
+    _, message_id, _ = batch.split(":")
+    if FOLD_CONFIRMATIONS and status_updater.add_note(bot, notify_chat, int(message_id), note):
+        return
+    confirmation = f"✅ Отправлено в {delivered} чатов"
+    if failed:
+        confirmation += f" (не удалось: {', '.join(failed)})"
+    confirmation += f": _{sentence}_"
+    await send_scheduler.send_message(bot, notify_chat, confirmation, parse_mode="Markdown")
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -308,107 +2547,150 @@ async def quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    chat_descriptions = []
-    for _, name, langs in TARGET_CHATS:
-        lang_str = "+".join(langs).upper()
-        chat_descriptions.append(f"{name} ({lang_str})")
-
-    chat_list = ", ".join(chat_descriptions)
-    await update.message.reply_text(f"⏳ Генерирую предложения для: {chat_list}...")
-
-    prompts = random.sample(GRAMMAR_STRUCTURES, 6)
-    sentences = generate_russian_sentences_batch(prompts)
-
-    active_quizzes[chat_id] = {
+    batch = sentence_pool.pop(chat_id)
+    if batch is not None:
+        sentences = batch["sentences"]
+        remember_topics(batch.get("topics", []), chat_id)
+        rotation.remember_grammar(batch.get("structures", []), chat_id)
+    else:
+        chat_descriptions = []
+        for _, name, langs in TARGET_CHATS:
+            lang_str = "+".join(langs).upper()
+            chat_descriptions.append(f"{name} ({lang_str})")
+
+        chat_list = ", ".join(chat_descriptions)
+        if DEEPSEEK_STREAM:
+            await stream_quiz(update, chat_id, f"⏳ Генерирую предложения для: {chat_list}...")
+            return
+        await update.message.reply_text(f"⏳ Генерирую предложения для: {chat_list}...")
+
+        prompts = pick_grammar_structures(QUIZ_SIZE, chat_id)
+        sentences = await generate_russian_sentences_batch(prompts, chat_id)
+
+    cancel_speculative_translations(chat_id)
+    quiz_translation_tasks[chat_id] = start_speculative_translations(sentences)
+    quiz_data = {
         'sentences': sentences,
         'sent_count': 0,
-        'message_id': None
+        'message_id': None,
+        'expires_at': time.time() + QUIZ_TTL
     }
 
-    buttons = []
-    for i, sent in enumerate(sentences):
-        buttons.append([InlineKeyboardButton(f"📝 {sent}", callback_data=f"send_{i}")])
-    buttons.append([InlineKeyboardButton("✅ Готово", callback_data="finish")])
-
-    message = await update.message.reply_text(
-        f"🎯 **Выбери предложения для отправки ({len(TARGET_CHATS)} чатов):**\n\n"
-        "• Нажми на предложение чтобы отправить его\n"
-        "• Кнопки активны 30 секунд\n"
-        "• Нажми '✅ Готово' когда закончишь",
-        reply_markup=InlineKeyboardMarkup(buttons)
-    )
-    active_quizzes[chat_id]['message_id'] = message.message_id
-    asyncio.create_task(cleanup_quiz(chat_id))
+    text, keyboard = _quiz_status(quiz_data)
+    message = await update.message.reply_text(text, reply_markup=keyboard)
+    status_updater.track(chat_id, message.message_id, text, keyboard)
+    quiz_data['message_id'] = message.message_id
+    state_store.put_quiz(chat_id, quiz_data)
+    quiz_expiry_wakeup.set()
+
+
+async def stream_quiz(update: Update, chat_id: int, progress_text: str):
+    """Show the keyboard right away and add each sentence as the streamed batch produces it.
+
+    Keyboard edits go through `status_updater`, so they are coalesced to one
+    per STATUS_EDIT_INTERVAL; the header is replaced by the normal quiz text
+    once the batch is complete. Until then the session's expiry covers the
+    stream and repair deadlines, and QUIZ_TTL starts once the last sentence
+    is in.
+    """
+    cancel_speculative_translations(chat_id)
+    quiz_translation_tasks[chat_id] = []
+    message = await update.message.reply_text(progress_text, reply_markup=_quiz_keyboard([]))
+    status_updater.track(chat_id, message.message_id, progress_text, _quiz_keyboard([]))
+    expires_at = (time.time() + _deadline_for("generate_stream")
+                  + GENERATION_REPAIR_ROUNDS * _deadline_for("repair") + QUIZ_TTL)
+    quiz_data = {
+        'sentences': [],
+        'sent_count': 0,
+        'message_id': message.message_id,
+        'expires_at': expires_at
+    }
+    state_store.put_quiz(chat_id, quiz_data)
+    quiz_expiry_wakeup.set()
+
+    def still_open(quiz_data) -> bool:
+        # Clicks may update the session mid-stream; /quiz, ✅ or expiry may end it
+        if quiz_data is not None and quiz_data['message_id'] == message.message_id:
+            return True
+        logger.info(f"Quiz in chat {chat_id} closed while streaming")
+        # ✅ has already replaced the header; a newer /quiz or expiry leave it to us
+        if quiz_data is not None:
+            status_updater.set_status(update.get_bot(), chat_id, message.message_id,
+                                      "⏹ Этот набор заменён новым /quiz.")
+        elif time.time() >= expires_at:
+            status_updater.set_status(update.get_bot(), chat_id, message.message_id,
+                                      "❌ Время вышло! Используй /quiz чтобы начать заново.")
+        return False
+
+    prompts = pick_grammar_structures(QUIZ_SIZE, chat_id)
+    async for sentence in stream_russian_sentences_batch(prompts, chat_id):
+        quiz_data = state_store.get_quiz(chat_id)
+        if not still_open(quiz_data):
+            return
+        quiz_data['sentences'].append(sentence)
+        state_store.put_quiz(chat_id, quiz_data)
+        quiz_translation_tasks.setdefault(chat_id, []).append(start_speculative_translation(sentence))
+
+        if len(quiz_data['sentences']) < QUIZ_SIZE:
+            text = _quiz_status(quiz_data)[0] if quiz_data['sent_count'] else progress_text
+            status_updater.set_status(update.get_bot(), chat_id, message.message_id, text,
+                                      _quiz_keyboard(quiz_data['sentences']))
+
+    quiz_data = state_store.get_quiz(chat_id)
+    if still_open(quiz_data):
+        quiz_data['expires_at'] = time.time() + QUIZ_TTL
+        state_store.put_quiz(chat_id, quiz_data)
+        quiz_expiry_wakeup.set()
+        status_updater.set_status(update.get_bot(), chat_id, message.message_id, *_quiz_status(quiz_data))
 
 
 async def send_sentence(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Queue the clicked sentence for delivery.
+
+    The click costs one query.answer (its toast is the immediate feedback);
+    the status message is updated through `status_updater`, which merges
+    rapid clicks and delivery confirmations into as few edits as possible.
+    """
     query = update.callback_query
-    await query.answer()
     chat_id = query.message.chat_id
+    message_id = query.message.message_id
 
-    if chat_id not in active_quizzes:
-        await query.edit_message_text("❌ Время вышло! Используй /quiz чтобы начать заново.")
+    quiz_data = state_store.get_quiz(chat_id)
+    if quiz_data is None or quiz_data['expires_at'] <= time.time():
+        status_updater.set_status(context.bot, chat_id, message_id,
+                                  "❌ Время вышло! Используй /quiz чтобы начать заново.")
+        await query.answer()
         return
 
     if query.data == "finish":
-        sent_count = active_quizzes[chat_id]['sent_count']
-        await query.edit_message_text(f"✅ Отправлено предложений: {sent_count}\n\nИспользуй /quiz для нового набора.")
-        if chat_id in active_quizzes:
-            del active_quizzes[chat_id]
+        sent_count = quiz_data['sent_count']
+        status_updater.set_status(context.bot, chat_id, message_id,
+                                  f"✅ Отправлено предложений: {sent_count}\n\nИспользуй /quiz для нового набора.")
+        cleanup_quiz(chat_id)
+        await query.answer()
         return
 
     try:
         idx = int(query.data.split("_")[1])
-        quiz_data = active_quizzes[chat_id]
         sentences = quiz_data['sentences']
 
         if 0 <= idx < len(sentences):
             russian_sentence = sentences[idx]
-            sent_to = []
-            failed = []
-
-            for target_id, student_name, langs in TARGET_CHATS:
-                try:
-                    for lang_code in langs:
-                        if lang_code == "ru":
-                            await context.bot.send_message(chat_id=target_id, text=russian_sentence)
-                        else:
-                            translated = translate_sentence(russian_sentence, lang_code)
-                            await context.bot.send_message(chat_id=target_id, text=translated)
-                        if len(langs) > 1:
-                            await asyncio.sleep(0.5)
-
-                    lang_str = "+".join(langs).upper()
-                    sent_to.append(f"{student_name} ({lang_str})")
-                    logger.info(f"Sentence {idx} sent to {student_name} ({target_id}) in {langs}")
-                except Exception as e:
-                    failed.append(student_name)
-                    logger.error(f"Failed to send to {student_name} ({target_id}): {e}")
-
-            quiz_data['sent_count'] += 1
-            sent_count = quiz_data['sent_count']
-
-            status_parts = []
-            if sent_to:
-                status_parts.append(f"✅ {', '.join(sent_to)}")
-            if failed:
-                status_parts.append(f"❌ {', '.join(failed)}")
-            status_info = f" ({' | '.join(status_parts)})" if status_parts else ""
-
-            await query.edit_message_text(
-                f"🎯 **Отправлено: {sent_count}/6{status_info}**\n\n"
-                "• Нажми на предложение чтобы отправить его\n"
-                "• Кнопки активны 30 секунд\n"
-                "• Нажми '✅ Готово' когда закончишь",
-                reply_markup=query.message.reply_markup
+            # Delivery (translation included) happens on the outbox workers
+            added = outbox.enqueue(
+                quiz_batch_key(chat_id, quiz_data['message_id'], idx), chat_id, russian_sentence,
+                [(target_id, langs) for target_id, _, langs in TARGET_CHATS]
             )
+            if not added:
+                logger.info(f"Sentence {idx} of quiz {quiz_data['message_id']} was already queued")
+                await query.answer("Это предложение уже отправлено")
+                return
+            logger.info(f"Sentence {idx} queued for {len(TARGET_CHATS)} chats ({added} messages)")
 
-            confirmation = f"✅ Отправлено в {len(sent_to)} чатов"
-            if failed:
-                confirmation += f" (не удалось: {len(failed)})"
-            confirmation += f": _{russian_sentence}_"
-
-            await context.bot.send_message(chat_id=chat_id, text=confirmation, parse_mode="Markdown")
+            quiz_data['sent_count'] += 1
+            state_store.put_quiz(chat_id, quiz_data)
+            status_updater.set_status(context.bot, chat_id, message_id, *_quiz_status(quiz_data))
+            await query.answer(f"📤 Отправляю в {len(TARGET_CHATS)} чатов")
         else:
             await query.answer("❌ Предложение не найдено", show_alert=True)
 
@@ -434,43 +2716,153 @@ REMINDER_MESSAGES = [
 ]
 
 
-def send_reminder():
-    if not REMINDER_CHAT_ID:
-        return
+async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue callback: runs on the bot's own event loop and connection pool."""
     en, he, trans = random.choice(REMINDER_MESSAGES)
     text = f"{en}\n*{he}*\n_{trans}_"
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        async def send_async():
-            bot = Application.builder().token(TELEGRAM_BOT_TOKEN).build().bot
-            await bot.send_message(chat_id=REMINDER_CHAT_ID, text=text, parse_mode="Markdown")
-
-        loop.run_until_complete(send_async())
-        loop.close()
-        logger.info("✅ Reminder sent")
+        await send_scheduler.send_message(context.bot, context.job.chat_id, text, parse_mode="Markdown")
+        logger.info(f"✅ Reminder sent to {context.job.chat_id}")
     except Exception as e:
-        logger.error(f"Failed to send reminder: {e}")
+        logger.error(f"Failed to send reminder to {context.job.chat_id}: {e}")
 
 
-def start_scheduler():
-    if not REMINDER_CHAT_ID:
-        logger.info("No REMINDER_CHAT_ID — scheduler not started.")
+def schedule_reminders(application: Application):
+    if not REMINDER_TARGETS:
+        logger.info("No REMINDER_CHAT_ID / REMINDER_CONFIG — reminders not scheduled.")
         return
-    scheduler = BackgroundScheduler(timezone=pytz.utc)
-    scheduler.add_job(send_reminder, CronTrigger(hour=10, minute=0, timezone=pytz.utc))
-    scheduler.add_job(send_reminder, CronTrigger(hour=16, minute=0, timezone=pytz.utc))
-    scheduler.start()
-    logger.info("⏰ Reminder scheduler started")
+    for chat_id, times in REMINDER_TARGETS:
+        for reminder_time in times:
+            application.job_queue.run_daily(
+                send_reminder, reminder_time, chat_id=chat_id, name=f"reminder_{chat_id}"
+            )
+    logger.info(f"⏰ Scheduled reminders for {len(REMINDER_TARGETS)} chat(s)")
+
+
+async def post_init(application: Application):
+    application.bot_data['quiz_expiry_task'] = asyncio.create_task(run_quiz_expiry())
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await start_metrics_server()
+        application.bot_data['loop_lag_task'] = asyncio.create_task(monitor_event_loop_lag())
+    await sentence_pool.start()
+    await outbox.start(application.bot)
+
+
+async def post_shutdown(application: Application):
+    for name in ('quiz_expiry_task', 'loop_lag_task'):
+        task = application.bot_data.get(name)
+        if task is not None:
+            task.cancel()
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server is not None:
+        metrics_server.close()
+    await sentence_pool.stop()
+    await outbox.stop()
+    await close_deepseek_client()
+    logger.info(f"Translation cache stats: {translation_cache.stats()}")
+    translation_cache.close()
+    outbox.close()
+    state_store.close()
+
+
+# --- Webhook mode ---
+def webhook_handler(application: Application, ready: asyncio.Event):
+    """HTTP handler for start_http_server: Telegram updates on WEBHOOK_PATH plus /healthz and /readyz."""
+
+    async def handle(method: str, path: str, headers: dict, body: bytes):
+        path = path.split("?", 1)[0]
+        if method == "GET" and path == "/healthz":
+            return 200, "text/plain", b"ok"
+        if method == "GET" and path == "/readyz":
+            if ready.is_set() and application.running:
+                return 200, "text/plain", b"ready"
+            return 503, "text/plain", b"not ready"
+        if path != WEBHOOK_PATH:
+            return 404, "text/plain", b"not found"
+        if method != "POST":
+            return 405, "text/plain", b"method not allowed"
+        if not hmac.compare_digest(
+                headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+            logger.warning("Rejected webhook request with a wrong secret token")
+            return 403, "text/plain", b"forbidden"
+        if not ready.is_set():
+            return 503, "text/plain", b"not ready"
+        try:
+            data = json.loads(body)
+            update = Update.de_json(data, application.bot) if isinstance(data, dict) else None
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            update = None
+        if update is None:
+            return 400, "text/plain", b"bad request"
+        # Handlers run on the application's update processor; answer Telegram right away
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+
+    return handle
+
+
+async def run_webhook(application: Application):
+    """Serve updates from the embedded HTTP server until SIGINT/SIGTERM.
+
+    Mirrors run_polling's lifecycle (initialize, post_init, start, then stop,
+    shutdown, post_shutdown), but registers WEBHOOK_URL + WEBHOOK_PATH with
+    Telegram instead of long-polling getUpdates.
+    """
+    stop = asyncio.Event()
+    ready = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    server = None
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        server = await start_http_server(webhook_handler(application, ready), WEBHOOK_LISTEN, WEBHOOK_PORT)
+        port = server.sockets[0].getsockname()[1]
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f"🤖 Webhook registered at {WEBHOOK_URL}{WEBHOOK_PATH}")
+        else:
+            logger.info("WEBHOOK_URL is empty, not registering the webhook with Telegram")
+        ready.set()
+        logger.info(f"🤖 Listening for updates on http://{WEBHOOK_LISTEN}:{port}{WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        ready.clear()
+        if server is not None:
+            server.close()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 
 def main():
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("quiz", quiz))
-    application.add_handler(CallbackQueryHandler(send_sentence))
-    start_scheduler()
+    if UPDATE_MODE == "webhook" and not WEBHOOK_SECRET:
+        # Without it anyone who can reach WEBHOOK_PORT could post fake updates
+        raise SystemExit("UPDATE_MODE=webhook requires WEBHOOK_SECRET")
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    if UPDATE_MODE == "webhook":
+        builder = builder.updater(None)  # updates come from the embedded server, not getUpdates
+    application = builder.build()
+    application.add_handler(CommandHandler("start", instrumented(start)))
+    application.add_handler(CommandHandler("quiz", instrumented(quiz)))
+    application.add_handler(CallbackQueryHandler(instrumented(send_sentence)))
+    schedule_reminders(application)
+    if UPDATE_MODE == "webhook":
+        logger.info("🤖 Starting bot with webhook...")
+        asyncio.run(run_webhook(application))
+        return
     logger.info("🤖 Starting bot with polling...")
     application.run_polling()
 